@@ -18,8 +18,7 @@ def load_rules():
 
 def get_req_urls():
     q = "SELECT req_id, url FROM requests where ad IS null"
-    rows = storage.execute(q).fetchall()
-    return [(r[0], r[1]) for r in rows]
+    return list(storage.iterate(q, row_type=tuple))
 
 
 def update_db(items, status):
@@ -37,12 +36,19 @@ def sec_to_time(sec):
 def mark_ads():
     rules = load_rules()
 
+    storage.add_ad_column()
     reqs = get_req_urls()
+    print("got: {} requests".format(len(reqs)))
+    # batch the updates into large transactions
+    with storage.BulkIngest() as bulk:
+        _classify(rules, reqs, bulk)
+
+
+def _classify(rules, reqs, bulk):
     ads = []
     not_ads = []
 
     num_req = len(reqs)
-    print("got: {} requests".format(num_req))
     start = default_timer()
     for i, req in enumerate(reqs):
         req_id, url = req
@@ -57,8 +63,9 @@ def mark_ads():
             now = default_timer()
             time = now-start
             est = sec_to_time(time*((num_req-i)/1000))
-            print("@ {} : ads: {} : not: {} in {:.2f} : est left: {}".format(
-                    i, len(ads), len(not_ads), time, est))
+            print("@ {} : ads: {} : not: {} in {:.2f} : est left: {} "
+                  ": {:.0f} rows/s".format(i, len(ads), len(not_ads), time,
+                                           est, bulk.rate()))
             start = now
             ads = []
             not_ads = []
@@ -1,9 +1,14 @@
 """Analysis Utilities"""
 
+import collections
+import functools
 import glob
+import itertools
 import logging
+import multiprocessing
 import operator
 import os
+import sqlite3
 import urlparse
 
 import haralyzer
@@ -12,11 +17,97 @@ from tabulate import tabulate
 from publicsuffixlist import PublicSuffixList
 
 from carl import depends
+from carl import harstream
 from carl import utils
 from carl import storage
 
 
 psl = None
+# netloc -> (etld, priv) lookups shared across modules, see DomainCache
+domains = None
+
+
+class DomainCache(object):
+    """Bounded LRU cache of netloc -> (etld, priv)
+
+    The same few thousand netlocs make up most requests, so the tld and public
+    suffix lookups are only performed once per netloc.  The cache can be
+    persisted to the domains table so later ingests start warm.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # lookups added since take_new, for the ingest workers
+        self.new = []
+
+    def lookup(self, netloc, scheme="http"):
+        """Return (etld, priv) for the netloc"""
+        try:
+            value = self.cache.pop(netloc)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            value = split_domain(netloc, scheme)
+            self.new.append((netloc, value))
+            if len(self.cache) >= self.max_size:
+                self.cache.popitem(last=False)
+        # (re)insert as the most recently used
+        self.cache[netloc] = value
+        return value
+
+    def take_new(self):
+        """Return (new lookups, hits, misses) since the last call and reset
+        them, a worker's share of the lookups"""
+        taken = (self.new, self.hits, self.misses)
+        self.new = []
+        self.hits = 0
+        self.misses = 0
+        return taken
+
+    def merge(self, new, hits, misses):
+        """Add a worker's share of the lookups (see take_new)"""
+        self.hits += hits
+        self.misses += misses
+        for netloc, value in new:
+            self.cache.pop(netloc, None)
+            if len(self.cache) >= self.max_size:
+                self.cache.popitem(last=False)
+            self.cache[netloc] = value
+
+    def load(self):
+        """Warm the cache from the domains table"""
+        rows = storage.execute("SELECT * FROM domains LIMIT ?",
+                               (self.max_size,))
+        for row in rows:
+            self.cache[row["netloc"]] = (row["etld"], row["priv"])
+        logging.info("Loaded {} cached domains".format(len(self.cache)))
+
+    def save(self):
+        """Persist the cached lookups to the domains table"""
+        rows = [(netloc, etld, priv)
+                for netloc, (etld, priv) in self.cache.iteritems()]
+        return storage.store_rows(storage.Domain, rows)
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = self.hits/float(total) if total else 0
+        return "hits: {} : misses: {} : hit rate: {:.2f} : size: {}".format(
+            self.hits, self.misses, rate, len(self.cache))
+
+
+def split_domain(netloc, scheme="http"):
+    """Uncached (etld, priv) lookup for a netloc"""
+    priv = psl.privatesuffix(netloc)
+    try:
+        domain = urlparse.urlunparse((scheme, netloc, "", "", "", ""))
+        parse_tld = tld.get_tld(domain)
+    # occurs on instances like IP addresses
+    except tld.exceptions.TldDomainNotFound:
+        parse_tld = None
+    return parse_tld, priv
 
 ##
 # Functions used in parsing flat files into database
@@ -36,89 +127,266 @@ def har_to_page(h_name):
         return normalized
 
 
-def _parse_har(h_name):
-    """ Given the path of a har file, parse it and return a list of Request
-    objects that it contains
+def _har_entries(h_name):
+    """ Yield the request fields of each entry in a har file via haralyzer
+
+    Each item is (url, start_time, complete, status, content_hash) where
+    complete marks entries with both a request and response.
     """
     har_parser = haralyzer.HarParser(utils.load_json(h_name))
-    page_id = har_to_page(h_name)
-    req_per_har = []
     for p in har_parser.pages:
         for e in p.entries:
-            url = urlparse.urlparse(e['request']['url'])
-            query = urlparse.parse_qsl(url.query, keep_blank_values=True)
-            start_time = e['startedDateTime']
-            try:
-                domain = urlparse.urlunparse(
-                        (url.scheme, url.netloc, "", "", "", ""))
-                parse_tld = tld.get_tld(domain)
-                priv = psl.privatesuffix(url.netloc)
-            # occurs on instances like IP addresses
-            except tld.exceptions.TldDomainNotFound:
-                parse_tld = None
-
-            if e['request'] and e['response']:
+            status = None
+            text_hash = None
+            complete = bool(e['request'] and e['response'])
+            if complete:
                 resp = e['response']
-                if 'text' in resp['content']:
-                    text_hash = hash(resp['content']['text'])
-                else:
-                    text_hash = None
-                status = e['response']['status']
-                # This is a broken request, eg: never completed, or was left
-                #  dangling from a different page. Don't store
-                # if status == 0:
-                #    continue
-
-            # in the namespace of a single page load a requests url and time
-            # should uniquely identify a request
-            req_id = utils.get_uuid(page_id, "{}_{}".format(url, start_time))
-            data = {'req_id': req_id,
-                    'page_id': page_id,
-                    'status': status,
-                    'scheme': url.scheme,
-                    'url': e['request']['url'],
-                    'etld': parse_tld,
-                    'priv': priv,
-                    'netloc': url.netloc,
-                    'path': url.path,
-                    'query': str(query),
-                    'content_hash': text_hash}
-            req = storage.Request(data)
-            req_per_har.append(req)
+                text = resp['content'].get('text')
+                if isinstance(text, basestring):
+                    text_hash = harstream.text_hash(text)
+                status = resp['status']
+            yield (e['request']['url'], e['startedDateTime'], complete,
+                   status, text_hash)
+
+
+def iter_har_entries(h_name):
+    """ Stream the request fields of each entry in a har file
+
+    Yields the same items as _har_entries without loading the whole document,
+    response text is hashed as it is read.
+    """
+    with open(h_name, 'rb') as f:
+        for e in harstream.iter_entries(f):
+            complete = e['request'] and e['response']
+            yield (e['url'], e['startedDateTime'], complete, e['status'],
+                   e['content_hash'])
+
+
+def _parse_har(h_name, stream=False):
+    """ Given the path of a har file, parse it and return a list of Request
+    objects that it contains
+
+    stream - use the streaming reader instead of haralyzer
+    """
+    if stream:
+        entries = iter_har_entries(h_name)
+    else:
+        entries = _har_entries(h_name)
+    page_id = har_to_page(h_name)
+    req_per_har = []
+    for e in entries:
+        raw_url, start_time, complete, e_status, e_hash = e
+        url = urlparse.urlparse(raw_url)
+        query = urlparse.parse_qsl(url.query, keep_blank_values=True)
+        parse_tld, priv = domains.lookup(url.netloc, url.scheme)
+
+        if complete:
+            text_hash = e_hash
+            status = e_status
+            # This is a broken request, eg: never completed, or was left
+            #  dangling from a different page. Don't store
+            # if status == 0:
+            #    continue
+
+        # in the namespace of a single page load a requests url and time
+        # should uniquely identify a request
+        req_id = utils.get_uuid(page_id, "{}_{}".format(url, start_time))
+        data = {'req_id': req_id,
+                'page_id': page_id,
+                'status': status,
+                'scheme': url.scheme,
+                'url': raw_url,
+                'etld': parse_tld,
+                'priv': priv,
+                'netloc': url.netloc,
+                'path': url.path,
+                'query': str(query),
+                'content_hash': text_hash}
+        req = storage.Request(data)
+        req_per_har.append(req)
     return req_per_har
 
 
-def _store_metadata(paths):
+def _parse_har_rows(h_name, stream=False):
+    """ Parse a har file into rows of Request values
+
+    Used by the ingest workers so that only plain values cross the process
+    boundary back to the writer.
+    """
+    return [req.data.values() for req in _parse_har(h_name, stream)]
+
+
+def _parse_har_worker(h_name, stream=False):
+    """ _parse_har_rows in an ingest worker, along with its domain lookups
+    since the last file so the parent's cache sees them """
+    rows = _parse_har_rows(h_name, stream)
+    return rows, domains.take_new()
+
+
+def _init_worker():
+    """ Load the public suffix list once per ingest worker """
+    # forked workers inherit the list (and warm cache) from the parent
+    if not psl:
+        init_psl()
+    # only this worker's lookups are sent back
+    domains.take_new()
+
+
+def _load_manifest():
+    """ Return the manifest of already ingested files keyed by path """
+    rows = storage.execute("SELECT * FROM manifest")
+    return {row["path"]: row for row in rows}
+
+
+def _new_or_changed(paths, manifest):
+    """ Filter paths down to files that are new or changed since ingested
+
+    Files are only read (to compute a digest) when thier size or mtime differ
+    from the manifest.  Returns a list of (path, manifest entry, is_new).
+    """
+    changed = []
+    touched = []
+    for p in paths:
+        key = os.path.abspath(p)
+        st = os.stat(p)
+        known = manifest.get(key)
+        if known and known["size"] == st.st_size and \
+                known["mtime"] == st.st_mtime:
+            continue
+        entry = (key, st.st_size, st.st_mtime, utils.file_digest(p))
+        if known and known["digest"] == entry[3]:
+            # same content, just refresh the stat info
+            touched.append(entry)
+        else:
+            changed.append((p, entry, known is None))
+    storage.store_rows(storage.Manifest, touched, replace=True)
+    return changed
+
+
+def _store_metadata(paths, jobs=1, stream=False):
     runs, blocks, pages, har = paths
-    for i, r in enumerate(runs):
+    manifest = _load_manifest()
+
+    runs = _new_or_changed(runs, manifest)
+    all_runs = []
+    for i, (r, _, _) in enumerate(runs):
         logging.info("storing run: {} : {}".format(i, r))
-        run = storage.Run(utils.load_json(r))
-        run.store()
+        all_runs.append(storage.Run(utils.load_json(r)))
+    # files are only revisited when they changed, so replace what is stored
+    storage.store_many(all_runs, replace=True)
+    storage.store_rows(storage.Manifest, [e for _, e, _ in runs], True)
+
+    pages = _new_or_changed(pages, manifest)
     all_pages = []
-    for i, p in enumerate(pages):
+    replaced = []
+    for i, (p, _, is_new) in enumerate(pages):
         page = storage.Page(utils.load_json(p))
         all_pages.append(page)
-    cnt = storage.store_many(all_pages)
+        if not is_new:
+            replaced.append(page.data["page_id"])
+    cnt = storage.store_many(all_pages, replace=True)
+    storage.store_rows(storage.Manifest, [e for _, e, _ in pages], True)
+    _forget_pages(replaced)
     logging.info("Stored: {} pages".format(cnt))
 
-    already_loaded_har = [h[0] for h in storage.get("parsed_har")]
-    all_req = []
-    for i, h in enumerate(har):
-        if har_to_page(h) not in already_loaded_har:
-            logging.info("parsing HAR: {} : {}".format(i, h))
-            all_req += _parse_har(h)
-        else:
+    har_paths = har
+    har = _new_or_changed(har_paths, manifest)
+    # a changed HAR replaces every request of its page, the other HAR of
+    # that page (if any) are parsed again along with it
+    changed = set(har_to_page(h) for h, _, is_new in har if not is_new)
+    if changed:
+        logging.info("replacing the requests of {} pages".format(
+            len(changed)))
+        _delete_requests(changed)
+        _forget_pages(changed)
+        listed = set(h for h, _, _ in har)
+        for h in har_paths:
+            if h not in listed and har_to_page(h) in changed:
+                har.append((h, tuple(manifest[os.path.abspath(h)]), False))
+    already_loaded_har = None
+    to_parse = []
+    loaded = []
+    for i, (h, entry, is_new) in enumerate(har):
+        # har parsed before the manifest existed
+        if is_new and already_loaded_har is None:
+            already_loaded_har = set(
+                    row[0] for row in storage.get("parsed_har"))
+        if is_new and har_to_page(h) in already_loaded_har:
             logging.info("already parsed HAR: {} : {}".format(i, h))
-        # batch insert after everk 1000 har files parsed
-        if i % 1000 == 0:
-            cnt = storage.store_many(all_req)
-            logging.info("Stored: {} requests".format(cnt))
-            all_req = []
+            loaded.append(entry)
+        else:
+            to_parse.append((h, entry))
+    storage.store_rows(storage.Manifest, loaded, replace=True)
+    # loads counted before their requests arrived are counted again
+    _forget_pages(set(har_to_page(h) for h, _ in to_parse) - changed)
+
+    _store_requests(to_parse, jobs, stream)
+
+
+def _delete_requests(page_ids):
+    """ Delete the requests of page_ids """
+    storage.execute_many("DELETE FROM {} WHERE page_id == ?".format(
+        storage.request_table()), [(p,) for p in page_ids])
+
+
+def _forget_pages(page_ids):
+    """ Drop what was derived from the loads page_ids, their signatures
+    (see minhash) and url_stats (see jac3.update_url_stats) are redone """
+    for table in [storage.Signature, storage.StatsPage]:
+        storage.execute_many("DELETE FROM {} WHERE page_id == ?".format(
+            table.name), [(p,) for p in page_ids])
+
+
+def _store_requests(har, jobs=1, stream=False):
+    """ Parse the har files and store thier requests
+
+    har - list of (path, manifest entry) to parse
+
+    With jobs > 1 the parsing is spread over a pool of worker processes which
+    stream back rows, in order, to this process which owns the connection.
+    """
+    names = [h for h, _ in har]
+    pool = None
+    if jobs > 1:
+        logging.info("parsing HAR with {} workers".format(jobs))
+        pool = multiprocessing.Pool(jobs, _init_worker)
+        parse = functools.partial(_parse_har_worker, stream=stream)
+        parsed = _merge_domains(pool.imap(parse, names, chunksize=16))
+    else:
+        parse = functools.partial(_parse_har_rows, stream=stream)
+        parsed = itertools.imap(parse, names)
 
-    cnt = storage.store_many(all_req)
+    all_req = []
+    entries = []
+    try:
+        for i, ((h, entry), rows) in enumerate(itertools.izip(har, parsed)):
+            logging.info("parsing HAR: {} : {}".format(i, h))
+            all_req += rows
+            entries.append(entry)
+            # batch insert after everk 1000 har files parsed
+            if i % 1000 == 0:
+                cnt = storage.store_rows(storage.Request, all_req)
+                storage.store_rows(storage.Manifest, entries, replace=True)
+                logging.info("Stored: {} requests".format(cnt))
+                all_req = []
+                entries = []
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    cnt = storage.store_rows(storage.Request, all_req)
+    storage.store_rows(storage.Manifest, entries, replace=True)
     logging.info("Stored: {} requests".format(cnt))
 
 
+def _merge_domains(parsed):
+    """ Merge the workers' domain lookups into the cache, yielding the rows """
+    for rows, lookups in parsed:
+        domains.merge(*lookups)
+        yield rows
+
+
 def _paths_from_dir(data_dir):
     """Seach directory for har metadata files"""
     runs = glob.glob(data_dir + "/*_rundata.json")
@@ -130,35 +398,61 @@ def _paths_from_dir(data_dir):
 
 def init_psl(psl_dat=depends.priv_psl_path()):
     global psl
+    global domains
     with open(psl_dat, "rb") as f:
         psl = PublicSuffixList(f)
+    domains = DomainCache()
+
 
+def load_dir_to_db(data_dir=os.getcwd(), jobs=1, stream=False,
+                   cache_domains=True, layout="flat"):
+    """Parse the crawl output in data_dir into the database
 
-def load_dir_to_db(data_dir=os.getcwd()):
+    cache_domains - warm the domain lookup cache from the domains table and
+                    save it back once done
+
+    The per url statistics (see jac3.update_url_stats) are brought up to date
+    with the new loads once they are stored.
+    layout - request storage layout for a new database (see storage)
+    """
     db_path = os.path.join(os.getcwd(), "carl.sqlite3")
     logging.info("Populating db: {} from: {}".format(db_path, data_dir))
 
-    storage.initialize(db_path)
+    # indexes are created once the bulk load has finished
+    storage.initialize(db_path, indexes=False, layout=layout)
     paths = _paths_from_dir(data_dir)
     init_psl()
-    _store_metadata(paths)
+    if cache_domains:
+        domains.load()
+    with storage.BulkIngest():
+        _store_metadata(paths, jobs, stream)
+        if cache_domains:
+            domains.save()
+    logging.info("Domain cache: {}".format(domains.stats()))
+
+    # jac3 imports this module
+    from carl import jac3
+    jac3.update_url_stats(jobs=jobs)
 
 
 ##
 # Functions that operate on the database
 ##
 
+def iter_table(table, arraysize=storage.ARRAYSIZE):
+    """Stream a full table back as objects, one row at a time"""
+    if table in storage.ITEMS:
+        item_cls = storage.ITEMS[table]
+        for row in storage.stream(table, arraysize=arraysize):
+            yield item_cls.from_sql_row(row)
+
+
 def table_to_dict(table):
     """Handles loading in full tables back to objects"""
-    if table in storage.ITEMS:
-        rows = storage.get(table)
-        data = {}
-        for row in rows:
-            item = storage.ITEMS[table].from_sql_row(row)
-            data[item.data[item.pk]] = item
-        return data
-    else:
-        return {}
+    data = {}
+    for item in iter_table(table):
+        data[item.data[item.pk]] = item
+    return data
 
 
 def map_items_to_parent(items, parents):
@@ -183,41 +477,62 @@ def sum_on_field(item_list, field, value):
     return sum([1 for item in item_list if item.data[field] == value])
 
 
+RUN_STATS_Q = "SELECT r.*, "\
+              "COUNT(CASE WHEN p.get_status == 'success' THEN 1 END), "\
+              "COUNT(CASE WHEN p.get_status == 'timeout' THEN 1 END), "\
+              "COUNT(p.page_id), "\
+              "COUNT(CASE WHEN p.har_status == 'success' THEN 1 END) "\
+              "FROM runs AS r LEFT JOIN pages AS p ON p.run_id == r.run_id "\
+              "GROUP BY r.run_id ORDER BY r.start"
+
+
+def iter_run_stats():
+    """Stream one row of page load outcomes per run, ordered by start
+
+    The counting is done by sqlite, only one row per run is held here.
+    """
+    run_cols = len(storage.Run.cols)
+    for row in storage.iterate(RUN_STATS_Q):
+        run = storage.Run.from_sql_row(row)
+        success, timeout, total, har = tuple(row)[run_cols:]
+        error = total - (success + timeout)
+        yield [run.data["run_id"], run.data["name"], run.get_config(),
+               utils.epoch_fmt(run.data["start"]), run.data["time"],
+               success, timeout, error, har, run.other_info()]
+
+
+RUN_STATS_HEADERS = ["run_id", "name", "config", "start", "time", "success",
+                     "timeout", "error", "har", "other info"]
+
+
 def run_stats():
-    runs = table_to_dict("run")
-    pages = table_to_dict("page")
-
-    headers = ["run_id", "name", "config", "start", "time", "success",
-               "timeout", "error", "har", "other info"]
-    table = []
-    run_page_list = map_items_to_parent(pages, runs)
-    for run_id, page_list in run_page_list.iteritems():
-        row = []
-        run = runs[run_id]
-        row.append(run.data["run_id"])
-        row.append(run.data["name"])
-        row.append(run.get_config())
-        row.append(utils.epoch_fmt(run.data["start"]))
-        row.append(run.data["time"])
-
-        success = sum_on_field(page_list, "get_status", "success")
-        timeout = sum_on_field(page_list, "get_status", "timeout")
-        error = len(page_list) - (success + timeout)
-        har = sum_on_field(page_list, "har_status", "success")
-
-        row += [success, timeout, error, har]
-        row.append(run.other_info())
-        table.append(row)
-
-    return table, headers
-
-
-def print_stats():
+    return list(iter_run_stats()), RUN_STATS_HEADERS
+
+
+def print_stats(output=None):
+    """ Print the run stats, or write them to the output csv file """
+    if output:
+        utils.save_csv(itertools.chain([RUN_STATS_HEADERS], iter_run_stats()),
+                       output)
+        return
     data, headers = run_stats()
     data = sorted(data, key=operator.itemgetter(headers.index("start")))
     print_tabulated(data, headers)
 
 
+def print_query_plans():
+    """Show how sqlite executes each of the built in queries"""
+    for name, q in sorted(storage.GET_Q.iteritems()):
+        print("{}: {}".format(name, q))
+        try:
+            for step in storage.explain(q):
+                print("    {}".format(step))
+        except sqlite3.OperationalError as e:
+            # eg: requests.ad only exists once ads have been marked
+            print("    n/a: {}".format(e))
+        print("")
+
+
 def print_tabulated(data, headers=None):
     # common formatting corrections
     for i, h in enumerate(headers):
@@ -233,44 +548,32 @@ def print_tabulated(data, headers=None):
     print("")
 
 
-def keep_successful_url(browser_config):
-    # collect necessary data
-    runs = table_to_dict("run")
-    pages = table_to_dict("page")
-
-    pages_by_url = {}
-    # group pages into a list by url
-    for page_id, page in pages.iteritems():
-        url = page.data["url"]
-        run_id = page.data["run_id"]
-        # where the browser config matches
-        if runs[run_id].get_config() == browser_config:
-            if url in pages_by_url:
-                pages_by_url[url].append(page)
-            else:
-                pages_by_url[url] = [page]
-
-    successful_url = []
-    # only keep those where all page_loads resulted in a successful HAR capture
-    for url, page_list in pages_by_url.iteritems():
-        timeout = sum_on_field(page_list, "har_status", "success")
-        if timeout == len(page_list):
-            successful_url.append(url)
-
-    sorted_success = sorted(successful_url)
-    return sorted_success
+def iter_successful_url(browser_config):
+    """Stream, in order, the urls with a successful HAR capture on every
+    page load by runs of browser_config
 
+    The grouping is done by sqlite, runs are matched to the config here.
+    """
+    run_ids = [run.data["run_id"] for run in iter_table("run")
+               if run.get_config() == browser_config]
+    if len(run_ids) == 0:
+        return
+    q = "SELECT url FROM pages WHERE run_id IN ({}) GROUP BY url "\
+        "HAVING COUNT(*) == COUNT(CASE WHEN har_status == 'success' "\
+        "THEN 1 END) ORDER BY url".format(",".join("?"*len(run_ids)))
+    for row in storage.iterate(q, run_ids, row_type=tuple):
+        yield row[0]
 
-def save_successful_urls_by_config():
-    runs = table_to_dict("run")
 
-    run_configs = set()
-    # get all run configs
-    for r_id, run in runs.iteritems():
-        run_configs.add(run.get_config())
+def keep_successful_url(browser_config):
+    return list(iter_successful_url(browser_config))
 
+
+def save_successful_urls_by_config():
+    run_configs = set(run.get_config() for run in iter_table("run"))
     for conf in run_configs:
-        success = keep_successful_url(conf)
+        fname = "{}_valid.csv".format(conf)
         logging.info("Saving good urls for config: {} : {}".format(
-                     conf, len(success)))
-        utils.save_csv(enumerate(success), "{}_valid.csv".format(conf))
+                     conf, fname))
+        # streamed straight from the query to the file
+        utils.save_csv(enumerate(iter_successful_url(conf)), fname)
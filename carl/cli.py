@@ -11,6 +11,7 @@ from carl import manager
 from carl import utils
 from carl import storage
 from carl import web
+from carl import whitelist
 
 
 def parse_args():
@@ -85,11 +86,60 @@ def parse_args():
         help="filter out timeouts",
         action='store_true',
         default=False)
+    parser_analysis.add_argument(
+        "-j", "--jobs",
+        help="number of processes used to parse HAR files and compute "
+             "per url statistics (default: 1)",
+        type=int,
+        default=1)
+    parser_analysis.add_argument(
+        "-s", "--stream",
+        help="read HAR files incrementally instead of loading them whole",
+        action='store_true',
+        default=False)
+    parser_analysis.add_argument(
+        "-n", "--normalize",
+        help="store requests in the normalized (interned) layout when "
+             "creating a new database",
+        action='store_true',
+        default=False)
+    parser_analysis.add_argument(
+        "-a", "--approx",
+        help="estimate jaccard values with MinHash signatures, within this "
+             "error (eg: 0.05)",
+        type=float,
+        default=None)
+    parser_analysis.add_argument(
+        "-o", "--output",
+        help="write the stats to this csv file instead of printing them",
+        default=None)
     parser_analysis.add_argument(
         "action",
         help="available analysis actions",
         choices=["make_db", "stats", "jac", "jac_chart", "good_url",
-                 "web"])
+                 "web", "explain"])
+
+    # sub parser for serving whitelist decisions
+    parser_serve = subparsers.add_parser(
+        "serve-whitelist",
+        help="answer whether requests are whitelisted over HTTP/JSON")
+    parser_serve.add_argument(
+        "-p", "--port",
+        help="port to listen on (default: {})".format(
+            whitelist.DEFAULT_PORT),
+        type=int,
+        default=whitelist.DEFAULT_PORT)
+    parser_serve.add_argument(
+        "-b", "--bind",
+        help="address to listen on (default: all)",
+        default="")
+    parser_serve.add_argument(
+        "-i", "--fp-id",
+        help="the id of the stored fingerprint, when names are duplicated",
+        default=None)
+    parser_serve.add_argument(
+        "name",
+        help="name of the stored fingerprint (see store_fingerprints)")
 
     # sub parser for debugging
     parser_debug = subparsers.add_parser(
@@ -169,17 +219,25 @@ def run_command(args):
 
     elif args.command == "analysis":
         if args.action == "make_db":
-            analysis.load_dir_to_db()
+            layout = "normalized" if args.normalize else "flat"
+            analysis.load_dir_to_db(jobs=args.jobs, stream=args.stream,
+                                    layout=layout)
         elif args.action == "stats":
-            analysis.print_stats()
+            analysis.print_stats(args.output)
         elif args.action == "jac":
-            jaccard.print_jaccard_by_url(args.verbose, args.filt)
+            jaccard.print_jaccard_by_url(args.verbose, args.filt,
+                                         args.approx)
         elif args.action == "jac_chart":
             jaccard.chart_jaccard(args.filt)
         elif args.action == "good_url":
             analysis.save_successful_urls_by_config()
         elif args.action == "web":
             web.start_web()
+        elif args.action == "explain":
+            analysis.print_query_plans()
+
+    elif args.command == "serve-whitelist":
+        whitelist.serve(args.name, args.bind, args.port, args.fp_id)
 
     elif args.command == "debug":
         jaccard.inspect_url(args.url)
@@ -0,0 +1,402 @@
+"""Columnar Fingerprint Store
+
+Stored fingerprints (and their test results) are written as NumPy arrays, one
+.npy file per column in a directory per fingerprint, rather than pickled into
+the fingerprints table.  The arrays are memory mapped when read back, so a
+single site can be looked at without loading (or unpickling) the rest.
+
+Sites, page ids and whitelisted domains are interned as ids into string
+tables (the utf-8 bytes of every string and their offsets).  Everything that
+belongs to a site is a slice of the other columns, given by per site offsets:
+
+    sites     site urls (sorted) with offsets into windows and loads
+    windows   the fingerprints of each site, a single one unless rolling:
+              start, end, whitelisted domains, pages used
+    loads     the test results of each site, every load:
+              page, start time, evaluated, # requests, # failed
+
+Failed requests are only kept as counts, any failure details (see
+gen_fingerprint.failure_details) are pickled alongside.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+
+META = "meta.json"
+FAILURES = "failures.pickle"
+STATIC = "static"
+ROLLING = "rolling"
+# id of a missing (NULL) string
+NONE_ID = -1
+
+
+class _Interned(object):
+    """ Ids for strings, in order of first use """
+    __slots__ = ("ids", "values")
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def id(self, value):
+        if value is None:
+            return NONE_ID
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+    def columns(self, name):
+        return string_columns(name, self.values)
+
+
+def string_columns(name, values):
+    """ The bytes and offsets columns of a table of strings """
+    encoded = [unicode(v).encode("utf-8") for v in values]
+    offsets = np.cumsum([0] + [len(e) for e in encoded], dtype=np.int64)
+    blob = np.array(bytearray("".join(encoded)), dtype=np.uint8)
+    return {name + "_bytes": blob, name + "_offsets": offsets}
+
+
+def _float(value):
+    return np.nan if value is None else value
+
+
+def _unfloat(value):
+    return None if np.isnan(value) else float(value)
+
+
+def _failed_count(failed):
+    # results stored before failures were counted hold a list of them
+    if isinstance(failed, list):
+        return len(failed)
+    return failed
+
+
+def to_columns(fingerprints, results=None):
+    """
+    Convert fingerprints (and results), see gen_fingerprint, to columns
+    output: (meta, dict[column name]array, failures)
+    """
+    sites = sorted(set(fingerprints).union(results or {}))
+    if isinstance(fingerprints, StoredFingerprints):
+        rolling = fingerprints.store.meta["kind"] == ROLLING
+    else:
+        # a site's fingerprint is a dict of windows when rolling
+        first = next(fingerprints.itervalues(), None)
+        rolling = isinstance(first, dict)
+    domains = _Interned()
+    pages = _Interned()
+    site_strs = _Interned()
+
+    site_windows = [0]
+    win_start, win_end = [], []
+    win_domains, fp_domains = [0], []
+    win_used, used_pages = [0], []
+    site_loads = [0]
+    load_page, load_time, load_eval, load_total, load_failed = \
+        [], [], [], [], []
+    site_valid = []
+    site_res_used, res_used = [0], []
+    failures = {}
+
+    for site in sites:
+        site_strs.id(site)
+        fp = fingerprints.get(site)
+        if fp is None:
+            windows = []
+        elif rolling:
+            windows = [fp[i] for i in sorted(fp)]
+        else:
+            whitelist, used, valid_after = fp
+            windows = [{"fp": whitelist, "used": used, "start": valid_after,
+                        "end": None}]
+        for window in windows:
+            win_start.append(_float(window["start"]))
+            win_end.append(_float(window["end"]))
+            fp_domains.extend(domains.id(d) for d in window["fp"])
+            win_domains.append(len(fp_domains))
+            used_pages.extend(pages.id(p) for p in window["used"])
+            win_used.append(len(used_pages))
+        site_windows.append(len(win_start))
+
+        res = (results or {}).get(site)
+        if res is not None:
+            evaluated = res["evaluated"]
+            for page_id, start_time in res["load_to_time"].iteritems():
+                load_page.append(pages.id(page_id))
+                load_time.append(_float(start_time))
+                tot_req, failed, valid = evaluated.get(page_id, (0, 0, True))
+                load_eval.append(page_id in evaluated)
+                load_total.append(tot_req)
+                load_failed.append(_failed_count(failed))
+            res_used.extend(pages.id(p) for p in res["used_in_fp"])
+            if "failures" in res:
+                failures[site] = res["failures"]
+        site_loads.append(len(load_page))
+        site_valid.append(res is not None and res["all_valid"])
+        site_res_used.append(len(res_used))
+
+    columns = {
+        "site_windows": np.array(site_windows, dtype=np.int64),
+        "win_start": np.array(win_start, dtype=float),
+        "win_end": np.array(win_end, dtype=float),
+        "win_domains": np.array(win_domains, dtype=np.int64),
+        "fp_domains": np.array(fp_domains, dtype=np.int32),
+        "win_used": np.array(win_used, dtype=np.int64),
+        "used_pages": np.array(used_pages, dtype=np.int32),
+        "site_has_fp": np.array([s in fingerprints for s in sites],
+                                dtype=bool)}
+    columns.update(site_strs.columns("site"))
+    columns.update(domains.columns("domain"))
+    columns.update(pages.columns("page"))
+    if results is not None:
+        columns.update({
+            "site_loads": np.array(site_loads, dtype=np.int64),
+            "load_page": np.array(load_page, dtype=np.int32),
+            "load_time": np.array(load_time, dtype=float),
+            "load_eval": np.array(load_eval, dtype=bool),
+            "load_total": np.array(load_total, dtype=np.int32),
+            "load_failed": np.array(load_failed, dtype=np.int32),
+            "site_valid": np.array(site_valid, dtype=bool),
+            "site_has_res": np.array([s in results for s in sites],
+                                     dtype=bool),
+            "site_res_used": np.array(site_res_used, dtype=np.int64),
+            "res_used": np.array(res_used, dtype=np.int32)})
+    meta = {"kind": ROLLING if rolling else STATIC,
+            "results": results is not None}
+    return meta, columns, failures
+
+
+def content_id(meta, columns, failures):
+    """ Hash of everything stored, equal fingerprints share an id """
+    digest = hashlib.sha1(json.dumps(meta, sort_keys=True))
+    for name in sorted(columns):
+        digest.update(name)
+        digest.update(columns[name].tobytes())
+    digest.update(pickle.dumps(failures, 2))
+    return digest.hexdigest()[:16]
+
+
+def save(path, meta, columns, failures):
+    """ Write the columns to the directory path """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, column in columns.iteritems():
+        np.save(os.path.join(path, name + ".npy"), column)
+    if failures:
+        with open(os.path.join(path, FAILURES), "wb") as f:
+            pickle.dump(failures, f, 2)
+    # written last, a directory without it is incomplete
+    with open(os.path.join(path, META), "w") as f:
+        json.dump(meta, f)
+
+
+def add_columns(store, columns, last=None):
+    """ Write columns derived from a stored fingerprint alongside it
+
+    Each column is written to a temporary file and renamed into place, the
+    column last (whose presence marks the others as complete) after the rest.
+    """
+    names = sorted(columns, key=lambda name: name == last)
+    for name in names:
+        path = os.path.join(store.path, name + ".npy")
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, columns[name])
+        os.rename(path + ".tmp", path)
+        # drop any mapping of the replaced file
+        store._columns.pop(name, None)
+
+
+def update_meta(store, values):
+    """ Update (a None value removes) entries of the meta of a store """
+    meta = dict(store.meta)
+    for key, value in values.iteritems():
+        if value is None:
+            meta.pop(key, None)
+        else:
+            meta[key] = value
+    path = os.path.join(store.path, META)
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.rename(path + ".tmp", path)
+    store.meta = meta
+
+
+def exists(path):
+    return os.path.isfile(os.path.join(path, META))
+
+
+def load(path):
+    """ (fingerprints, results) read lazily, one site at a time """
+    store = Store(path)
+    results = StoredResults(store) if store.meta["results"] else None
+    return StoredFingerprints(store), results
+
+
+class Store(object):
+    """ Memory mapped columns of a stored fingerprint """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+        self._columns = {}
+        self._sites = None
+        self._failures = None
+
+    def __getitem__(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(
+                    os.path.join(self.path, name + ".npy"), mmap_mode="r")
+        return self._columns[name]
+
+    def has(self, name):
+        return os.path.isfile(os.path.join(self.path, name + ".npy"))
+
+    def string(self, table, i):
+        if i == NONE_ID:
+            return None
+        offsets = self[table + "_offsets"]
+        blob = self[table + "_bytes"][offsets[i]:offsets[i + 1]]
+        return blob.tobytes().decode("utf-8")
+
+    def strings(self, table, ids):
+        """ The strings of many ids, read as one slice of the table """
+        ids = np.asarray(ids, dtype=np.int64)
+        valid = ids != NONE_ID
+        offsets = self[table + "_offsets"]
+        starts = offsets[ids[valid]]
+        ends = offsets[ids[valid] + 1]
+        if len(starts) == 0:
+            return [None] * len(ids)
+        low = int(starts.min())
+        blob = self[table + "_bytes"][low:int(ends.max())].tobytes()
+        spans = iter(zip((starts - low).tolist(), (ends - low).tolist()))
+        out = []
+        for is_valid in valid.tolist():
+            if is_valid:
+                start, end = next(spans)
+                out.append(blob[start:end].decode("utf-8"))
+            else:
+                out.append(None)
+        return out
+
+    def sites(self):
+        """ dict[site url]index """
+        if self._sites is None:
+            count = len(self["site_offsets"]) - 1
+            self._sites = {self.string("site", i): i for i in range(count)}
+        return self._sites
+
+    def span(self, offsets, i):
+        offsets = self[offsets]
+        return int(offsets[i]), int(offsets[i + 1])
+
+    def failures(self):
+        if self._failures is None:
+            path = os.path.join(self.path, FAILURES)
+            self._failures = {}
+            if os.path.isfile(path):
+                with open(path, "rb") as f:
+                    self._failures = pickle.load(f)
+        return self._failures
+
+
+class _StoredMapping(collections.Mapping):
+    """ dict[site url] read from the store on access """
+
+    def __init__(self, store, has):
+        self.store = store
+        self.has = has
+
+    def _index(self, site):
+        i = self.store.sites().get(site)
+        if i is None or not self.store[self.has][i]:
+            raise KeyError(site)
+        return i
+
+    def __iter__(self):
+        has = self.store[self.has]
+        return (site for site, i in sorted(self.store.sites().iteritems())
+                if has[i])
+
+    def __len__(self):
+        return int(np.count_nonzero(self.store[self.has]))
+
+    def __contains__(self, site):
+        try:
+            self._index(site)
+        except KeyError:
+            return False
+        return True
+
+
+class StoredFingerprints(_StoredMapping):
+    """ The fingerprint of each site, as generated """
+
+    def __init__(self, store):
+        super(StoredFingerprints, self).__init__(store, "site_has_fp")
+
+    def __getitem__(self, site):
+        store = self.store
+        first, last = store.span("site_windows", self._index(site))
+        windows = {}
+        for w in range(first, last):
+            windows[w - first] = {
+                    "fp": set(store.strings(
+                        "domain", store["fp_domains"][
+                            slice(*store.span("win_domains", w))])),
+                    "used": set(store.strings(
+                        "page", store["used_pages"][
+                            slice(*store.span("win_used", w))])),
+                    "start": _unfloat(store["win_start"][w]),
+                    "end": _unfloat(store["win_end"][w])}
+        if store.meta["kind"] == ROLLING:
+            return windows
+        window = windows[0]
+        return (window["fp"], window["used"], window["start"])
+
+
+class StoredResults(_StoredMapping):
+    """ The test results of each site, failed requests as counts """
+
+    def __init__(self, store):
+        super(StoredResults, self).__init__(store, "site_has_res")
+
+    def __getitem__(self, site):
+        store = self.store
+        i = self._index(site)
+        loads = slice(*store.span("site_loads", i))
+        page_ids = store.strings("page", store["load_page"][loads])
+        times = store["load_time"][loads]
+        evaluated = {}
+        for page_id, evaled, tot_req, failed in zip(
+                page_ids, store["load_eval"][loads],
+                store["load_total"][loads].tolist(),
+                store["load_failed"][loads].tolist()):
+            if evaled:
+                evaluated[page_id] = (tot_req, failed, failed == 0)
+        res = {"evaluated": evaluated,
+               "used_in_fp": set(store.strings(
+                   "page", store["res_used"][
+                       slice(*store.span("site_res_used", i))])),
+               "all_valid": bool(store["site_valid"][i]),
+               "load_to_time": {p: _unfloat(t)
+                                for p, t in zip(page_ids, times)}}
+        if site in store.failures():
+            res["failures"] = store.failures()[site]
+        return res
+
+    def failed(self):
+        """ The sites that failed on at least one load """
+        valid = self.store["site_valid"]
+        has = self.store["site_has_res"]
+        return sorted(site for site, i in self.store.sites().iteritems()
+                      if has[i] and not valid[i])
@@ -6,17 +6,23 @@
 # Stated another way, given a training data set of page loads, predict valid
 # future domains.
 
+import heapq
+import multiprocessing
 import os
 import pickle
 import urlparse
 # import base64
 import time
+import warnings
+from collections import Set, namedtuple
+from itertools import groupby
 from operator import itemgetter
 from functools import partial
 from datetime import timedelta, datetime
 
 import numpy as np
 
+from carl import fp_store
 from carl import storage
 import carl.viz_fingerprint as viz
 import carl.analysis as analysis
@@ -53,55 +59,79 @@ def first_n_loads(request_data, prior_fingerprint=[], n=1):
     return (fingerprint, set(analyzed), valid_after)
 
 
-def rolling_update(request_data, n=1, f=timedelta(days=7), cumulative=True):
+def rolling_update(request_data, n=1, f=timedelta(days=7), cumulative=True,
+                   load_privs=None):
+    """
+    Heuristic: a series of fingerprints, each from n loads and valid for f
+    after the last of them.  The next is from the n loads before the first
+    load past the end of the previous one (or the next n loads).
+    inputs:
+        request_data: time ordered loads, as from iter_site_loads
+        cumulative: each fingerprint includes the ones before it
+        load_privs: the set of privs of each load in request_data, when
+                    already computed (see sweep)
+    output: dict[index]{"fp", "used", "start", "end"}
+
+    Windows are scheduled on an array of the load start times (with
+    np.searchsorted) rather than copying and scanning what remains of the
+    loads, and each one first only records the domains it adds.
+    """
+    if load_privs is None:
+        def privs(i):
+            return set(req["priv"] for req in request_data[i][1])
+    else:
+        privs = load_privs.__getitem__
+    times = np.array([-np.inf if t is None else t
+                      for (_, t), _ in request_data], dtype=float)
+    in_order = not np.any(times[1:] < times[:-1])
+    end = len(request_data)
+    epoch = datetime.utcfromtimestamp(0)
 
-    data = request_data
-    fp_index = 0
-    fp = set()
-    fingerprints = {}
-    overall_index = 0
-    while len(data) > n:
-        # print "loads left:{}".format(len(data))
+    windows = []
+    seen = set()
+    start = 0
+    while end - start > n:
+        # Still take the first n loads from the block
+        analyzed = []
+        added = set()
+        for i in range(start, start + n):
+            analyzed.append(request_data[i][0]["page_id"])
+            # only care about the root part of the fdqn
+            added.update(privs(i))
         # if we are not cummaulatively incorperatinge fingerprints, reset
         if not cumulative:
             print "Resetting fp"
-            fp = set()
-        # othwerwise copy forward
+        # othwerwise only keep what is new
         else:
-            fp = set().union(fp)
-        analyzed = []
-
-        # Still take the first n loads from the block
-        n_loads = data[:n]
-        for load in n_loads:
-            (page_id, start_time), load_req = load
-            analyzed.append(page_id)
-            for req in load_req:
-                # only care about the root part of the fdqn
-                fp.add(req["priv"])
+            added.difference_update(seen)
+            seen.update(added)
 
         # Perform time/frequency calculations
-        valid_after = n_loads[-1][0]["start_time"]
+        valid_after = request_data[start + n - 1][0]["start_time"]
         valid_until = (datetime.utcfromtimestamp(valid_after) + f)
-        epoch = datetime.utcfromtimestamp(0)
         until_epoch = (valid_until - epoch).total_seconds()
+        windows.append((added, analyzed, valid_after, until_epoch))
+
+        # Setup for the next charachterization block, the first load past
+        # the period, once enough have been observed for the next fp
+        if in_order:
+            past = np.searchsorted(times, until_epoch, "left") - start
+            next_start = min(end - start, max(n + 1, past)) - n
+        else:
+            next_start = get_next_start_n(request_data[start:], until_epoch, n)
+        start += next_start
 
-        # Update the fingerprint
+    fp = set()
+    fingerprints = {}
+    for fp_index, (added, analyzed, valid_after, until_epoch) in \
+            enumerate(windows):
+        fp = fp.union(added) if cumulative else added
         fingerprints[fp_index] = {
                 "fp": fp,
                 "used": set(analyzed),
                 "start": valid_after,
                 "end": until_epoch}
 
-        # Setup for the next charachterization block
-        fp_index += 1
-        next_start = get_next_start_n(data, until_epoch, n)
-        if next_start:
-            overall_index += next_start
-            data = data[next_start:]
-        else:
-            break
-
     # display_fingerprint_info(fingerprints, request_data)
     return fingerprints
 
@@ -145,35 +175,69 @@ def epoch_to_load_index(data, epoch):
         return -1
 
 
-def add_global_top(fingerprints, k=0, q=99, sty=1):
-    # single static fp
-    if sty == 1:
-        # excludes self
-        fp_sizes, whitelist_doms = summarize_fingerprints(fingerprints)
-    else:
-        # rolling fp (just slice off the first fingerprint)
-        fp0 = {site: {0: data[0]} for site, data in fingerprints.iteritems()}
-        fp_sizes, whitelist_doms = summarize_fingerprints(fp0, sty=2)
-
+def add_global_top(fingerprints, k=0, q=99, sty=1, freq=None):
+    """
+    Add the domains most frequently whitelisted (excluding self) by the
+    (first) fingerprint of every site to all of the fingerprints, either the
+    top k or those above the qth percentile (see high_freq_wl_domains)
+    sty=1: static single fingerprint
+    sty=2: rolling
+    freq: the domain_frequency of the fingerprints, when already computed
+    The fingerprints are left as is, each whitelist in the output is an
+    OverlaySet of it and the shared top domains.
+    """
+    whitelist_doms = freq
+    if whitelist_doms is None:
+        whitelist_doms = domain_frequency(fingerprints, sty)
     if k != 0:
         top_k = high_freq_wl_domains(whitelist_doms, k=k)
     else:
         top_k = high_freq_wl_domains(whitelist_doms, qth=q)
 
-    top_sites = [x[0] for x in top_k]
+    top_sites = frozenset(x[0] for x in top_k)
     print "Adding top global: {} sites".format(len(top_sites))
-    if sty == 1:
-        add_top_k = partial(add_to_whitelist, additions=top_sites)
-        ud_fps = {url: add_top_k(fp) for url, fp in fingerprints.iteritems()}
-    # CLOBBERS in place
-    if sty == 2:
-        for site, site_data in fingerprints.iteritems():
-            for fp_index, fp_data in site_data.iteritems():
-                fp_data["fp"].update(top_sites)
-        ud_fps = fingerprints
+    ud_fps = {}
+    for url, fp in fingerprints.iteritems():
+        if sty == 1:
+            (wl, analyzed, valid_after) = fp
+            ud_fps[url] = (OverlaySet(wl, top_sites), analyzed, valid_after)
+        else:
+            ud_fps[url] = {
+                    fp_index: dict(fp_data,
+                                   fp=OverlaySet(fp_data["fp"], top_sites))
+                    for fp_index, fp_data in fp.iteritems()}
     return ud_fps
 
 
+class OverlaySet(Set):
+    """
+    A whitelist with the domains of a shared overlay added, without copying
+    (or changing) the whitelist
+    """
+
+    def __init__(self, base, overlay):
+        self.base = base
+        self.overlay = overlay
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return set(it)
+
+    def __contains__(self, dom):
+        return dom in self.base or dom in self.overlay
+
+    def __iter__(self):
+        for dom in self.base:
+            yield dom
+        for dom in self.overlay:
+            if dom not in self.base:
+                yield dom
+
+    def __len__(self):
+        return len(self.base) + sum(
+                1 for dom in self.overlay if dom not in self.base)
+
+
 def add_to_whitelist(fingerprint, additions):
     """ Given a fingerprint, add to the whitelist """
     (fp, analyzed, valid_after) = fingerprint
@@ -181,58 +245,86 @@ def add_to_whitelist(fingerprint, additions):
     return(fp, analyzed, valid_after)
 
 
-def gen_fingerprint(limit=0, n=1, f=30, fp_func=None):
+def gen_fingerprint(limit=0, n=1, f=30, fp_func=None, workers=1):
     """
     inputs:
         limit: the number of sites to gen for, useful for testing
                0 = test all
+        workers: number of processes to spread the sites over (see map_sites)
     outputs: a dict mapping site_url to a fingerprint
     """
-    # Get all urls
-    sites = get_all_urls()
-    # slice to only analyze a few
-    if limit != 0:
-        sites = sites[:limit]
+    fingerprints, _ = gen_and_test(limit, n, f, fp_func, test=False,
+                                   workers=workers)
+    return fingerprints
+
 
-    if fp_func == "same-origin" and not analysis.psl:
+def gen_and_test(limit=0, n=1, f=30, fp_func=None, test=True, verbose=False,
+                 gran_func=None, workers=1, details=0):
+    """
+    Generate and test the fingerprint of each site in one pass over the data
+    inputs: as gen_fingerprint, test_fingerprint
+        test: False to only generate
+    outputs: (fingerprints, results), results is None when not testing
+
+    Rolling fingerprints (fp_func is None) are tested as in
+    test_rolling_fingerprint, all others as in test_fingerprint.
+    """
+    sites = limit_sites(limit)
+
+    if fp_func == "same-origin" and not analysis.domains:
         print "Initializing public suffix list"
         analysis.init_psl()
 
-    fingerprints = {}
-    # iterate over all url
-    for i, site in enumerate(sites):
-        site_url = site["url"]
-        print "fingerprinting : {} : {}".format(i, site_url)
-        pages = get_pages_for_url_time_orderd(site_url)
+    site_res = map_sites(_gen_and_test_site, sites,
+                         (n, f, fp_func, test, verbose, gran_func, details),
+                         workers, "fingerprinting")
+    fingerprints = {url: fp for url, (fp, _) in site_res.iteritems()}
+    results = None
+    if test:
+        results = {url: res for url, (_, res) in site_res.iteritems()}
+        print_test_summary(results)
+    return fingerprints, results
 
-        req_data = []
-        # collect requests for all loads
-        for load in pages:
-            page_id = load["page_id"]
-            load_req = get_requests_for_page_id(page_id)
-            req_data.append((load, load_req))
-
-        # Generate Fingerprint
-        # site_fingerprint = first_n_loads(req_data, n=n)
-        if fp_func is None:
-            site_fingerprint = rolling_update(
-                    req_data,
-                    n=n,
-                    f=timedelta(days=f))
-            # fingerprints[site_url] = site_fingerprint
-        elif fp_func == "same-origin":
-            parse_url = urlparse.urlparse(site_url)
-            priv = analysis.psl.privatesuffix(parse_url.netloc)
-
-            site_fingerprint = naive_same_origin(req_data, priv)
 
-        else:
-            # fp_func should be a partially applied function that just needs
-            # request data
-            site_fingerprint = fp_func(req_data)
+def limit_sites(limit=0):
+    """ The sites for map_sites, the first limit of them or (0) all """
+    # slice to only analyze a few
+    if limit != 0:
+        return {site["url"]: None for site in get_all_urls()[:limit]}
+    return None
+
+
+def _gen_and_test_site(site_url, req_data, _, n, f, fp_func, test, verbose,
+                       gran_func, details):
+    site_fingerprint = gen_site_fingerprint(site_url, req_data, n, f, fp_func)
+    if not test:
+        return site_fingerprint, None
+    elif fp_func is None:
+        return site_fingerprint, test_site_rolling_fingerprint(
+                site_fingerprint, req_data, verbose, details)
+    else:
+        return site_fingerprint, test_site_fingerprint(
+                site_fingerprint, req_data, verbose, gran_func, details)
 
-        fingerprints[site_url] = site_fingerprint
-    return fingerprints
+
+def gen_site_fingerprint(site_url, req_data, n=1, f=30, fp_func=None):
+    """ Fingerprint a single site from its loads (see iter_site_loads) """
+    # site_fingerprint = first_n_loads(req_data, n=n)
+    if fp_func is None:
+        return rolling_update(
+                req_data,
+                n=n,
+                f=timedelta(days=f))
+    elif fp_func == "same-origin":
+        parse_url = urlparse.urlparse(site_url)
+        _, priv = analysis.domains.lookup(parse_url.netloc)
+
+        return naive_same_origin(req_data, priv)
+
+    else:
+        # fp_func should be a partially applied function that just needs
+        # request data
+        return fp_func(req_data)
 
 
 def naive_path_n(request_data, n=1):
@@ -268,126 +360,338 @@ def path_gran(req):
     return req["netloc"] + req["path"]
 
 
-def test_fingerprint(fingerprints, verbose=False, gran_func=None, slim=False):
+def test_fingerprint(fingerprints, verbose=False, gran_func=None, slim=None,
+                     workers=1, details=0):
+    """
+    Test the fingerprint of each site, see test_site_fingerprint
+        slim: deprecated and ignored, failures are always counted
+    """
+    if slim is not None:
+        warnings.warn("test_fingerprint: slim is ignored, failures are "
+                      "always counted", DeprecationWarning, stacklevel=2)
+
+    results = map_sites(_test_site, fingerprints,
+                        (verbose, gran_func, details), workers,
+                        "testing")
+    print_test_summary(results)
+    return results
 
-    results = {}
-    i = 0
-    for site_url, fingerprint in fingerprints.iteritems():
-        print "testing : {} : {}".format(i, site_url)
-        i += 1
-        whitelist, used_pages, valid_after = fingerprint
-        # dict[page_id]{start_time}
-        all_pages = dict(get_pages_for_url_time_orderd(site_url))
-        all_page_id = set(all_pages.keys())
-        testable = all_page_id.difference(used_pages)
-        evaluated = {}
-        tot_valid = 0
-        # only evaluate on things not used in the training set
-        for page_id in testable:
-            page_req_time = all_pages[page_id]
-            # only evaluate after fingerprint is valid for
-            if page_req_time > valid_after:
-                page_valid = True
-                failed = []
-                test_req = get_requests_for_page_id(page_id)
-                # tuple (# requests, [failed], pass)
-                for req in test_req:
-                    # defalt
-                    if gran_func is None:
-                        if req["priv"] not in whitelist:
-                            if verbose:
-                                # This is a lot of information to keep around
-                                failed.append(list(req))
-                            elif slim:
-                                # just use the length later
-                                # TODO: add ability to track length directly
-                                failed.append(1)
-                            else:
-                                failed.append(req["url"])
-
-                            page_valid = False
-                    else:
-                        if gran_func(req) not in whitelist:
-                            failed.append(req["url"])
-                            page_valid = False
 
-                if page_valid:
-                    tot_valid += 1
-                result = (len(test_req), failed, len(failed) == 0)
-                evaluated[page_id] = result
+def _test_site(site_url, req_data, fingerprint, verbose, gran_func, details):
+    return test_site_fingerprint(
+            fingerprint, req_data, verbose, gran_func, details)
 
-        results[site_url] = {"evaluated": evaluated,
-                             "used_in_fp": used_pages,
-                             "all_valid": tot_valid == len(evaluated),
-                             "load_to_time": all_pages}
 
-    num_valid = sum([1 for x in results.values() if x["all_valid"]])
-    failed = {k: v for k, v in results.iteritems() if not v["all_valid"]}
-    print "Total: {}".format(len(results))
-    print "Perfect: {}".format(num_valid)
-    print "Failed: {}".format(len(failed))
+def test_site_fingerprint(fingerprint, req_data, verbose=False, gran_func=None,
+                          details=0, loads=None):
+    """
+    Test a single site's fingerprint against its loads
+    inputs:
+        gran_func: the whitelisted value of a request, default its priv
+        verbose, details: see failure_details
+        loads: encode_loads(req_data, gran_func), when already encoded (after
+               compiling the whitelist)
+    output: a dict holding the evaluated loads, each as
+            (# requests, # failed, pass)
+    """
+    whitelist, used_pages, valid_after = fingerprint
+    # dict[page_id]{start_time}
+    all_pages = dict(load for load, _ in req_data)
+    whitelist_ids = compile_whitelist(whitelist)
+    if loads is None:
+        loads = encode_loads(req_data, gran_func)
+    page_ids, times, sizes, ids = loads
+    failed = failed_counts(ids, sizes, whitelist_ids)
+
+    evaluated = {}
+    tot_valid = 0
+    for page_id, page_req_time, tot_req, page_failed in zip(
+            page_ids, times, sizes, failed):
+        # only evaluate on things not used in the training set
+        if page_id in used_pages:
+            continue
+        # only evaluate after fingerprint is valid for
+        if page_req_time > valid_after:
+            # tuple (# requests, # failed, pass)
+            result = (tot_req, page_failed, page_failed == 0)
+            if result[2]:
+                tot_valid += 1
+            evaluated[page_id] = result
+
+    results = {"evaluated": evaluated,
+               "used_in_fp": used_pages,
+               "all_valid": tot_valid == len(evaluated),
+               "load_to_time": all_pages}
+    if verbose or details:
+        results["failures"] = failure_details(
+                req_data, evaluated, [whitelist], verbose, gran_func, details)
     return results
 
 
-def test_rolling_fingerprint(fingerprints, verbose=False):
-    results = {}
+def test_rolling_fingerprint(fingerprints, verbose=False, workers=1,
+                             details=0):
     # Iterate through all fingerprints on all sites
-    for site_url, data in fingerprints.iteritems():
-        # load site information from database
-        all_pages = dict(get_pages_for_url_time_orderd(site_url))
-        all_page_id = set(all_pages.keys())
-        evaluated = {}
-        tot_valid = 0
-
-        # Iterate over each fingerprint
-        for fp_index, fp_data in data.iteritems():
-            # get fingperprint data
-            whitelist = fp_data["fp"]
-            used_pages = fp_data["used"]
-            valid_after = fp_data["start"]
-            valid_until = fp_data["end"]
+    results = map_sites(_test_rolling_site, fingerprints, (verbose, details),
+                        workers)
+    print_test_summary(results)
+    return results
+
+
+def _test_rolling_site(site_url, req_data, data, verbose, details):
+    return test_site_rolling_fingerprint(data, req_data, verbose, details)
+
 
+def test_site_rolling_fingerprint(data, req_data, verbose=False, details=0,
+                                  loads=None):
+    """
+    Test each of a site's rolling fingerprints against its loads
+    Loads in the window of several fingerprints are evaluated by the first.
+    See test_site_fingerprint.
+    """
+    # dict[page_id]{start_time}
+    all_pages = dict(load for load, _ in req_data)
+    evaluated = {}
+    tot_valid = 0
+    used_pages = set()
+    whitelists = {}
+
+    # Find the loads each fingerprint evaluates
+    windows = []
+    for fp_index, fp_data in data.iteritems():
+        # get fingperprint data
+        used_pages = fp_data["used"]
+        valid_after = fp_data["start"]
+        valid_until = fp_data["end"]
+
+        testable = []
+        for i, ((page_id, page_req_time), _) in enumerate(req_data):
             # only evaluate on things not used in the training set
-            testable = all_page_id.difference(used_pages)
-            for page_id in testable:
-                page_req_time = all_pages[page_id]
-                # only evaluate after fingerprint is valid for
-                if page_req_time > valid_after and page_req_time < valid_until:
-                    page_valid = True
-                    failed = []
-                    test_req = get_requests_for_page_id(page_id)
-                    # tuple (# requests, [failed], pass)
-                    for req in test_req:
-                        if req["priv"] not in whitelist:
-                            if verbose:
-                                # This is a lot of information to keep around
-                                failed.append(list(req))
-                            else:
-                                failed.append(req["url"])
-
-                            page_valid = False
-                    if page_valid:
-                        tot_valid += 1
-                    result = (len(test_req), failed, len(failed) == 0)
-                    if page_id in evaluated:
-                        print "double checking a page"
-                    else:
-                        evaluated[page_id] = result
+            if page_id in used_pages:
+                continue
+            # only evaluate after fingerprint is valid for
+            if page_req_time > valid_after and page_req_time < valid_until:
+                testable.append(i)
+        if testable:
+            windows.append((fp_data["fp"], testable))
+
+    # Compile the whitelists before encoding the requests tested against them
+    windows = [(whitelist, compile_whitelist(whitelist), testable)
+               for whitelist, testable in windows]
+    if windows:
+        if loads is None:
+            loads = encode_loads(req_data)
+        page_ids, times, sizes, ids = loads
+
+        offsets = np.cumsum([0] + sizes)
+
+    # Iterate over each fingerprint
+    for whitelist, whitelist_ids, testable in windows:
+        # loads are in time order, so those in a window are (mostly) a run
+        first, last = testable[0], testable[-1] + 1
+        failed = failed_counts(ids[offsets[first]:offsets[last]],
+                               sizes[first:last], whitelist_ids)
+        for i in testable:
+            page_id = page_ids[i]
+            # tuple (# requests, # failed, pass)
+            result = (sizes[i], failed[i - first], failed[i - first] == 0)
+            if result[2]:
+                tot_valid += 1
+            if page_id in evaluated:
+                print "double checking a page"
+            else:
+                evaluated[page_id] = result
+                whitelists[page_id] = whitelist
+
+    # print len(evaluated)
+    results = {"evaluated": evaluated,
+               "used_in_fp": used_pages,
+               "all_valid": tot_valid == len(evaluated),
+               "load_to_time": all_pages}
+    if verbose or details:
+        results["failures"] = failure_details(
+                req_data, evaluated, whitelists, verbose, details=details)
+    return results
 
-        # print len(evaluated)
-        results[site_url] = {"evaluated": evaluated,
-                             "used_in_fp": used_pages,
-                             "all_valid": tot_valid == len(evaluated),
-                             "load_to_time": all_pages}
 
+def print_test_summary(results):
     num_valid = sum([1 for x in results.values() if x["all_valid"]])
     failed = {k: v for k, v in results.iteritems() if not v["all_valid"]}
     print "Total: {}".format(len(results))
     print "Perfect: {}".format(num_valid)
     print "Failed: {}".format(len(failed))
+
+
+###
+# Compiled Whitelists
+#
+# Whitelisted values are interned as integer ids, a whitelist is then a
+# sorted array of ids and all the requests of a site are tested against it
+# with one np.searchsorted.  Requests are encoded after the whitelists they
+# are tested against are compiled, any value not in one of them is
+# MISSING_ID.  Ids are never stored and only last for the sites of one
+# _map_sites call (of each worker), which keeps the table bounded.
+###
+DOMAIN_IDS = {}
+MISSING_ID = -1
+
+
+def compile_whitelist(whitelist):
+    """ Sorted array of the ids of a whitelist, interning any new values """
+    ids = set(DOMAIN_IDS.setdefault(v, len(DOMAIN_IDS)) for v in whitelist)
+    return np.array(sorted(ids), dtype=np.int64)
+
+
+def encode_loads(req_data, gran_func=None):
+    """
+    Encode a site's loads (see iter_site_loads) for compiled whitelists
+    output: (page_ids, start times, # requests of each load, ids), where ids
+            is an array of the ids of the gran_func (default priv) values of
+            every request of every load, load after load
+    """
+    page_ids = [page_id for (page_id, _), _ in req_data]
+    times = [start_time for (_, start_time), _ in req_data]
+    sizes = [len(load_req) for _, load_req in req_data]
+    get_id = DOMAIN_IDS.get
+    if gran_func is None:
+        ids = [get_id(req["priv"], MISSING_ID)
+               for _, load_req in req_data for req in load_req]
+    else:
+        ids = [get_id(gran_func(req), MISSING_ID)
+               for _, load_req in req_data for req in load_req]
+    return page_ids, times, sizes, np.array(ids, dtype=np.int64)
+
+
+def failed_counts(ids, sizes, whitelist_ids):
+    """ The number of requests of each load not in the compiled whitelist """
+    if len(whitelist_ids) == 0:
+        return list(sizes)
+    pos = np.searchsorted(whitelist_ids, ids)
+    missing = whitelist_ids[np.minimum(pos, len(whitelist_ids) - 1)] != ids
+    load = np.repeat(np.arange(len(sizes)), sizes)
+    return np.bincount(load[missing], minlength=len(sizes)).tolist()
+
+
+def failure_details(req_data, evaluated, whitelists, verbose=False,
+                    gran_func=None, details=0):
+    """
+    The failed requests of each evaluated load that failed
+    inputs:
+        whitelists: whitelist each load was tested against by page_id, or a
+                    list holding the one used for every load
+        verbose: keep the whole request rather than its url
+        details: keep (at most) the first details failed requests of a
+                 load, 0 = all of them
+    output: dict[page_id][failed requests]
+    """
+    if gran_func is None:
+        gran_func = itemgetter("priv")
+    failures = {}
+    for (page_id, _), load_req in req_data:
+        if page_id not in evaluated or evaluated[page_id][2]:
+            continue
+        if isinstance(whitelists, list):
+            whitelist = whitelists[0]
+        else:
+            whitelist = whitelists[page_id]
+        failed = [list(req) if verbose else req["url"]
+                  for req in load_req if gran_func(req) not in whitelist]
+        failures[page_id] = failed[:details] if details else failed
+    return failures
+
+
+def failed_count(failed):
+    """
+    The number of failed requests of an evaluated load, results stored
+    before failures were counted hold a list of them
+    """
+    if isinstance(failed, list):
+        return len(failed)
+    return failed
+
+
+def map_sites(func, site_args=None, args=(), workers=1, label=None):
+    """
+    Apply func(site_url, req_data, site_arg, *args) to the loads of each site
+    (see iter_site_loads) and return a dict mapping site_url to the result
+    inputs:
+        site_args: dict of site_url to the site_arg of that site (eg: its
+                   fingerprint), None = every site with a successful load
+                   and a site_arg of None.  Sites without a successful load
+                   get an empty req_data.
+        workers: number of processes, each gets contiguous (by url) slices of
+                 the sites and reads their loads over its own read only
+                 connection, the results are the same as with one
+        label: print progress as "label : i : site_url" (by slice with
+               workers > 1)
+    """
+    if site_args is None:
+        sites = [row[0] for row in storage.iterate(
+                GET_SUCCESS_URLS_ORDERED, row_type=tuple)]
+        site_args = dict.fromkeys(sites)
+    else:
+        sites = sorted(site_args)
+
+    results = {}
+    if workers > 1 and len(sites) > 1:
+        # several slices per worker so that a slow one doesn't hold up the rest
+        size = max(1, -(-len(sites) // (workers * 4)))
+        tasks = [(func, {url: site_args[url] for url in sites[i:i + size]},
+                  args) for i in range(0, len(sites), size)]
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (storage.database_file(),))
+        worker_time = {}
+        try:
+            for res, pid, elapsed in pool.imap_unordered(_map_sites_task,
+                                                         tasks):
+                results.update(res)
+                worker = worker_time.setdefault(pid, [pid, 0, 0.0])
+                worker[1] += len(res)
+                worker[2] += elapsed
+                if label:
+                    print "{} : {}/{} sites".format(
+                            label, len(results), len(sites))
+        finally:
+            pool.close()
+            pool.join()
+        analysis.print_tabulated(sorted(worker_time.values()),
+                                 ["worker", "sites", "seconds"])
+    else:
+        results = _map_sites(func, site_args, args, label)
+    return results
+
+
+def _map_sites(func, site_args, args, label=None):
+    results = {}
+    DOMAIN_IDS.clear()
+    try:
+        for i, (site_url, req_data) in enumerate(
+                iter_site_loads(site_args)):
+            if label:
+                print "{} : {} : {}".format(label, i, site_url)
+            results[site_url] = func(site_url, req_data,
+                                     site_args[site_url], *args)
+
+        # sites without any successful load left to test against
+        for site_url in set(site_args).difference(results):
+            results[site_url] = func(site_url, [], site_args[site_url],
+                                     *args)
+    finally:
+        DOMAIN_IDS.clear()
     return results
 
 
+def _init_worker(db_file):
+    # never share the parent's connection across the fork
+    storage.connect_db(db_file, read_only=True)
+
+
+def _map_sites_task(task):
+    start = time.time()
+    func, site_args, args = task
+    results = _map_sites(func, site_args, args)
+    return results, os.getpid(), time.time() - start
+
+
 ###
 # Helper Functions
 ###
@@ -398,23 +702,110 @@ def get_failed(res):
     res: the output of test_fingerprint
     return: a list of urls that had at least one false positive
     """
+    if isinstance(res, fp_store.StoredResults):
+        return res.failed()
     return [k for k, v in res.iteritems() if not v["all_valid"]]
 
 
-def gen_matrix(base_n=[1, 5, 10, 20], limit=0, prefix="test"):
+def sweep(first_n=(), rolling=(), limit=0, test=True, workers=1):
+    """
+    Generate (and test) the fingerprints of several configurations in one
+    pass over the data
+    inputs:
+        first_n: the n of each first_n_loads fingerprint
+        rolling: the (n, f) of each rolling fingerprint (see gen_fingerprint)
+        limit, workers: see gen_and_test
+    outputs: dict[config](fingerprints, results) for every config, either
+             ("first_n", n) or ("rolling", n, f), results are None when not
+             testing
+
+    Each site's loads are read once for all the configurations.  The first-n
+    fingerprints are the unions of a growing prefix of the loads, the domains
+    of each load are collected once for all of them and the rolling ones, and
+    the requests are encoded once for all of the tests.
+    """
+    first_n = sorted(set(first_n))
+    rolling = list(rolling)
+    site_res = map_sites(_sweep_site, limit_sites(limit),
+                         (first_n, rolling, test), workers, "sweeping")
+
+    configs = [("first_n", n) for n in first_n]
+    configs += [("rolling", n, f) for n, f in rolling]
+    sweep_res = {}
+    for config in configs:
+        fingerprints = {url: res[config][0]
+                        for url, res in site_res.iteritems()}
+        results = None
+        if test:
+            results = {url: res[config][1]
+                       for url, res in site_res.iteritems()}
+            print "Tested: {}".format(config)
+            print_test_summary(results)
+        sweep_res[config] = (fingerprints, results)
+    return sweep_res
+
+
+def first_n_prefixes(request_data, ns, load_privs=None):
+    """
+    first_n_loads for each n in (ascending) ns, each extending the previous
+    load_privs: as in rolling_update
+    """
+    if load_privs is None:
+        load_privs = [set(req["priv"] for req in load_req)
+                      for _, load_req in request_data]
+    fingerprint = set()
+    analyzed = []
+    prefixes = []
+    for n in ns:
+        for i in range(len(analyzed), min(n, len(request_data))):
+            analyzed.append(request_data[i][0]["page_id"])
+            fingerprint.update(load_privs[i])
+        valid_after = request_data[len(analyzed) - 1][0]["start_time"]
+        prefixes.append((set(fingerprint), set(analyzed), valid_after))
+    return prefixes
+
+
+def _sweep_site(site_url, req_data, _, first_n, rolling, test):
+    load_privs = [set(req["priv"] for req in load_req)
+                  for _, load_req in req_data]
+    fingerprints = {}
+    for n, fp in zip(first_n, first_n_prefixes(req_data, first_n,
+                                               load_privs)):
+        fingerprints[("first_n", n)] = fp
+    for n, f in rolling:
+        fingerprints[("rolling", n, f)] = rolling_update(
+                req_data, n=n, f=timedelta(days=f), load_privs=load_privs)
+    if not test:
+        return {config: (fp, None) for config, fp in fingerprints.iteritems()}
+
+    # compile every whitelist before encoding the requests for all the tests
+    for config, fp in fingerprints.iteritems():
+        if config[0] == "first_n":
+            compile_whitelist(fp[0])
+        else:
+            for fp_data in fp.itervalues():
+                compile_whitelist(fp_data["fp"])
+    loads = encode_loads(req_data)
+
+    site_res = {}
+    for config, fp in fingerprints.iteritems():
+        if config[0] == "first_n":
+            res = test_site_fingerprint(fp, req_data, loads=loads)
+        else:
+            res = test_site_rolling_fingerprint(fp, req_data, loads=loads)
+        site_res[config] = (fp, res)
+    return site_res
+
+
+def gen_matrix(base_n=[1, 5, 10, 20], limit=0, prefix="test", workers=1):
 
     print "Generate baseline (first-n) fingerprints"
+    sweep_res = sweep(first_n=base_n, limit=limit, workers=workers)
     for n in base_n:
-        print "Gen n={}".format(n)
-        fp = gen_fingerprint(n=n, limit=limit)
-        print "test fingerprint"
-        res = test_fingerprint(fp)
+        fp, res = sweep_res[("first_n", n)]
         name = "{}.{}.{}.{}".format(prefix, "first_n", n, limit)
         print "Store: {}".format(name)
         store_fingerprints(fp, name, res)
-        # Clear mem
-        fp = None
-        res = None
 
 
 def fingerprint_test_and_chart(name="",
@@ -422,7 +813,8 @@ def fingerprint_test_and_chart(name="",
                                n=1,
                                chart_sty="stacked",
                                title="",
-                               y_max=100):
+                               y_max=100,
+                               workers=1):
 
     if limit == 0:
         tot_num = len(get_all_urls())
@@ -440,10 +832,9 @@ def fingerprint_test_and_chart(name="",
         dataset = os.path.basename(os.getcwd())
         title = "{} ; {} ; n={}".format(dataset, sample, n)
 
-    print "Generating fingerprint for: {}".format(limit)
-    fp = gen_fingerprint(limit, n)
-    print "Testing fingerprint"
-    res = test_fingerprint(fp)
+    print "Generating and testing fingerprint for: {}".format(limit)
+    fp, res = gen_and_test(limit, fp_func=partial(first_n_loads, n=n),
+                           workers=workers)
 
     print chart_sty
     if chart_sty == "line":
@@ -516,6 +907,10 @@ def save_fingerprint_for_plugin(fingerprints, output="filterlist.txt"):
 ##
 
 
+# false positive rates, the first bin is loads without any
+FP_BINS = [0, 0.0000001, 5, 10, 15, 100]
+
+
 def mean_list(lst):
     return np.mean(np.array(lst))
 
@@ -538,8 +933,8 @@ def nth_percentile(lst, n):
 
 def make_stacked(results, name, title):
     print "making stacked chart"
-    indexed_data = avg_false_positive_rate(results)
-    viz.binned_fp_stacked_area(indexed_data, name, title)
+    binned = binned_false_positive_rate(results)
+    viz.binned_fp_stacked_area(binned, name, title)
 
 ###
 # Chart/Graph Helpers
@@ -552,25 +947,86 @@ def make_box(results, name, title, sum_func=mean_list, y_max=100):
     viz.box_and_whiskers(agg_data, name, title, y_max=y_max)
 
 
+def false_positive_matrix(res):
+    """
+    Given: the failure rate as determined by test_fingerprint
+    Return: (sites, rates, x_max) the false positive rate of each site's
+            evaluated loads in time order, a row per site padded with NaN,
+            and x_max the number of loads of the last site (in the order of
+            res, see below)
+    """
+    sites = []
+    lengths = []
+    tot_reqs = []
+    failures = []
+    for site in res:
+        site_res = res[site]["evaluated"]
+        page_times = res[site]["load_to_time"]
+        # sort page_id by time, only the evaluated loads are indexed
+        sorted_times = sorted(page_times.items(), key=itemgetter(1))
+        evaluated = [site_res[page_id] for page_id, _ in sorted_times
+                     if page_id in site_res]
+        sites.append(site)
+        lengths.append(len(evaluated))
+        for tot_req, failed, valid in evaluated:
+            tot_reqs.append(tot_req)
+            failures.append(failed_count(failed))
+
+    lengths = np.array(lengths, dtype=int)
+    width = lengths.max() if len(lengths) else 0
+    rates = np.full((len(sites), width), np.nan)
+    # each row's loads are a prefix of it
+    loaded = np.arange(width) < lengths[:, None]
+    # a load without requests has nothing to fail, a rate of 0 rather than
+    # a NaN that would pass for padding
+    tot_reqs = np.array(tot_reqs, dtype=float)
+    load_rates = np.zeros(len(tot_reqs))
+    np.divide(failures, tot_reqs, out=load_rates, where=tot_reqs > 0)
+    rates[loaded] = load_rates * 100
+    # as in the original time_order_false_positive_percent, x_max is the
+    # length of the last site iterated (not the longest), which depends on
+    # the order of res; kept so the charts and aggregates are unchanged
+    x_max = lengths[-1] if len(lengths) else 0
+    return sites, rates, x_max
+
+
 def avg_false_positive_rate(res):
     """
     Given: The results of testing a fingerprint
     Return: A time ordered index of the false positive rate observed with
             by applying that fingerprint to the new data
+    """
+    sites, rates, x_max = false_positive_matrix(res)
+    # at each x index, join the false positive rates of all sites
+    return [(x, col[~np.isnan(col)].tolist())
+            for x, col in enumerate(rates[:, :x_max].T)]
+
+
+def binned_false_positive_rate(res, bins=FP_BINS):
+    """
+    Given: The results of testing a fingerprint
+    Return: The fraction of sites in each bin of false positive rate at each
+            load index, see avg_false_positive_rate
+            Indexes with fewer than 90% of the most sites seen so far are
+            left out, those without enough data due to failed loads (~2%)
     Used by the binned_fp_stacked_area visualization
     """
-    site_profile, x_max = time_order_false_positive_percent(res)
+    sites, rates, x_max = false_positive_matrix(res)
+    rates = rates[:, :x_max]
+    loaded = ~np.isnan(rates)
+    index_tot = loaded.sum(axis=0).astype(float)
 
-    indexed_data = []
-    for x in range(x_max):
-        x_data = []
-        # at each x index, join the false positive rates of all sites
-        for site, data in site_profile.iteritems():
-            if x in data:
-                x_data.append(data[x])
-        indexed_data.append((x, x_data))
+    # as np.histogram, the last bin includes its upper edge
+    nbins = len(bins) - 1
+    binned = np.digitize(rates, bins) - 1
+    binned[rates == bins[-1]] = nbins - 1
+    in_bins = loaded & (binned >= 0) & (binned < nbins)
+    x = np.broadcast_to(np.arange(x_max), rates.shape)
+    counts = np.bincount(x[in_bins] * nbins + binned[in_bins],
+                         minlength=x_max * nbins).reshape(x_max, nbins)
 
-    return indexed_data
+    enough = index_tot / np.maximum.accumulate(index_tot) >= 0.9
+    return (counts / index_tot[:, None])[enough].tolist()
 
 
 def time_order_false_positive_percent(res):
@@ -578,64 +1034,46 @@ def time_order_false_positive_percent(res):
     Given: the failure rate as determined by test_fingerprint
     Return: A time orderd false positive rate for each site and max_x
     """
+    sites, rates, x_max = false_positive_matrix(res)
     site_profile = {}
+    for site, row in zip(sites, rates):
+        site_profile[site] = dict(enumerate(row[~np.isnan(row)].tolist()))
+    return site_profile, x_max
 
-    # x_max = 0
-    for site in res:
-        site_res = res[site]["evaluated"]
-        page_times = res[site]["load_to_time"]
-        # used = res[site]["used_in_fp"]
-
-        data_points = []
-        # sort page_id by time
-        sorted_times = sorted(page_times.items(), key=itemgetter(1))
-
-        # had previouly excluded used so everytihng got a consistent order
-        # ordered_id = [x[0] for x in sorted_times if x[0] not in used]
-        ordered_id = [x[0] for x in sorted_times]
-        page_to_index = dict(zip(ordered_id, range(len(ordered_id))))
-        # x_max = max(x_max, len(page_to_index))
-
-        for page_id, page_res in site_res.iteritems():
-            tot_req, failed, valid = page_res
-            load_fp = (len(failed)/float(tot_req)) * 100
-            # append as a tuple with index first to allow sorting
-            data_points.append((page_to_index[page_id], load_fp))
-
-        data_points = sorted(data_points)
-        i = 0
-        shifted = []
-        # shift all to account for gaps based on used set
-        for (_, rate) in data_points:
-            shifted.append((i, rate))
-            i += 1
-        site_profile[site] = dict(shifted)
 
-    return site_profile, len(shifted)
+# the NaN ignoring equivalent of each summarize_func, applied to every site
+NAN_SUMMARIES = {mean_list: np.nanmean,
+                 max_list: np.nanmax,
+                 min_list: np.nanmin,
+                 median_list: np.nanmedian}
 
 
 def summerize_and_aggregate(res,
                             num_agg=20,
                             summarize_func=mean_list):
 
-    site_profile, x_max = time_order_false_positive_percent(res)
+    sites, rates, x_max = false_positive_matrix(res)
 
     if num_agg > x_max:
         num_agg = x_max
     step = x_max/num_agg
     # aggregate loads at the interval nessecary to achieve num_agg bins
     agg_bin = np.arange(step, x_max+1, step)
-
-    agg_data = {k: [] for k in agg_bin}
-    for site, data in site_profile.iteritems():
-        prev_bound = 0
-        for bound in agg_bin:
-            bin_data = [data[x] for x in data if x < bound and x >= prev_bound]
-            # discard any empty bins
-            if len(bin_data) > 0:
-                summary_metric = summarize_func(bin_data)
-                agg_data[bound].append(summary_metric)
-            prev_bound = bound
+    # the bin of each load index, [prev_bound, bound)
+    load_bin = np.digitize(np.arange(rates.shape[1]), agg_bin)
+    nan_func = NAN_SUMMARIES.get(summarize_func)
+
+    agg_data = {}
+    for i, bound in enumerate(agg_bin):
+        bin_rates = rates[:, load_bin == i]
+        # discard any empty bins
+        bin_rates = bin_rates[~np.isnan(bin_rates).all(axis=1)]
+        if nan_func is not None:
+            summary = nan_func(bin_rates, axis=1).tolist()
+        else:
+            summary = [summarize_func(row[~np.isnan(row)])
+                       for row in bin_rates]
+        agg_data[bound] = summary
     return agg_data
 
 
@@ -664,7 +1102,7 @@ def summarize_fingerprints(fingerprints, exclude_self=True, sty=1):
     sty=1: static single fingerprint
     sty=2: rolling
     """
-    if not analysis.psl:
+    if not analysis.domains:
         print "Initializing public suffix list"
         analysis.init_psl()
     fp_sizes = []
@@ -672,7 +1110,7 @@ def summarize_fingerprints(fingerprints, exclude_self=True, sty=1):
     for url, fp in fingerprints.iteritems():
         # Necessary to remove self from global space
         parse_url = urlparse.urlparse(url)
-        priv = analysis.psl.privatesuffix(parse_url.netloc)
+        _, priv = analysis.domains.lookup(parse_url.netloc)
 
         if sty == 1:
             wl,  used, valid = fp
@@ -711,52 +1149,126 @@ def high_freq_wl_domains(whitelist_doms, qth=90, k=0):
     """
     Get either the top qth percentile domains or the top n domains that are
     whitelisted
+    whitelist_doms: dict[domain]count or a DomainFrequency
+    output: [(domain, count)] most frequent first
     """
+    if isinstance(whitelist_doms, DomainFrequency):
+        if k != 0:
+            return whitelist_doms.top(k)
+        return whitelist_doms.above(qth)
 
-    sorted_wl_elem = sorted(whitelist_doms.items(),
-                            key=itemgetter(1),
-                            reverse=True)
-
+    if k != 0:
+        return heapq.nlargest(k, whitelist_doms.iteritems(),
+                              key=itemgetter(1))
     qth_per = np.percentile(whitelist_doms.values(), qth)
-    high_freq_qth = [(dom, x) for (dom, x) in sorted_wl_elem if x > qth_per]
-    high_freq_k = sorted_wl_elem[:k]
+    high_freq_qth = [(dom, x) for (dom, x) in whitelist_doms.iteritems()
+                     if x > qth_per]
+    return sorted(high_freq_qth, key=itemgetter(1), reverse=True)
 
-    if k != 0:
-        return high_freq_k
+
+# columns of the DomainFrequency kept with a stored fingerprint
+FREQ = "freq"
+FREQ_COUNTS = "freq_counts"
+FREQ_QUANTILES = "freq_quantiles"
+# store meta entry, the sty the columns were computed for
+FREQ_STY = "freq_sty"
+
+
+def domain_frequency(fingerprints, sty=1):
+    """
+    The DomainFrequency of the (first) whitelist of every site, excluding
+    self (see summarize_fingerprints)
+    For stored fingerprints (see load_fingerprint) it is computed once (for
+    the last sty asked for) and kept alongside them.
+    """
+    stored = isinstance(fingerprints, fp_store.StoredFingerprints)
+    if stored:
+        store = fingerprints.store
+        if store.meta.get(FREQ_STY) == sty and store.has(FREQ_COUNTS):
+            return DomainFrequency.from_store(store)
+
+    if sty == 1:
+        fp_sizes, whitelist_doms = summarize_fingerprints(fingerprints)
     else:
-        return high_freq_qth
+        # rolling fp (just slice off the first fingerprint)
+        fp0 = {site: {0: data[0]} for site, data in fingerprints.iteritems()}
+        fp_sizes, whitelist_doms = summarize_fingerprints(fp0, sty=2)
+    freq = DomainFrequency.from_counts(whitelist_doms)
+    if stored:
+        # the meta entry is only set once every column is in place
+        fp_store.update_meta(store, {FREQ_STY: None})
+        fp_store.add_columns(store, freq.columns(), last=FREQ_COUNTS)
+        fp_store.update_meta(store, {FREQ_STY: sty})
+    return freq
 
 
-def technique_whitelist_perfect_over_time(results):
+class DomainFrequency(object):
+    """
+    The number of fingerprints whitelisting each domain, most frequent first,
+    and the percentiles (0 through 100) of those counts
+    """
+
+    def __init__(self, domains, counts, quantiles):
+        # a list of domains, or the store holding them
+        self.domains = domains
+        self.counts = counts
+        self.quantiles = quantiles
+
+    @classmethod
+    def from_counts(cls, whitelist_doms):
+        ranked = sorted(whitelist_doms.iteritems(), key=itemgetter(1),
+                        reverse=True)
+        counts = np.array([x for _, x in ranked], dtype=np.int64)
+        quantiles = np.percentile(counts, range(101)) if len(counts) else \
+            np.zeros(0)
+        return cls([dom for dom, _ in ranked], counts, quantiles)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls(store, store[FREQ_COUNTS], store[FREQ_QUANTILES])
+
+    def columns(self):
+        columns = fp_store.string_columns(FREQ, self.domains)
+        columns[FREQ_COUNTS] = self.counts
+        columns[FREQ_QUANTILES] = self.quantiles
+        return columns
+
+    def percentile(self, qth):
+        if qth == int(qth) and 0 <= qth <= 100:
+            return self.quantiles[int(qth)]
+        return np.percentile(self.counts, qth)
+
+    def top(self, k):
+        """ The k most frequent (domain, count) """
+        k = min(k, len(self.counts))
+        if isinstance(self.domains, fp_store.Store):
+            domains = self.domains.strings(FREQ, range(k))
+        else:
+            domains = self.domains[:k]
+        return zip(domains, self.counts[:k].tolist())
+
+    def above(self, qth):
+        """ The (domain, count) more frequent than the qth percentile """
+        if len(self.counts) == 0:
+            return []
+        # counts are in decreasing order
+        k = np.searchsorted(-self.counts, -self.percentile(qth), "left")
+        return self.top(int(k))
 
-    bins = [0, 0.0000001, 5, 10, 15, 100]
-    indexed_data = avg_false_positive_rate(results)
-
-    # DUPE: from stacked bin
-    y_data = []
-    y_max = 0
-    for x in indexed_data:
-        index, data = x
-        index_tot = float(len(data))
-        y_max = max(y_max, index_tot)
-        # Need to handle situations where we no longer have enough data,
-        # due to failed loads. ~2% of data
-        if index_tot/float(y_max) >= 0.9:
-            normed_bins = [x/index_tot for x in np.histogram(data, bins)[0]]
-            y_data.append(normed_bins)
-
-    just_perfect = [x[0] for x in y_data]
-    # print just_perfect[:5]
-    # print just_perfect[-5:]
-    # wl_avg_perfect = sum(just_perfect)/float(len(just_perfect))
-    # return wl_avg_perfect
-    return just_perfect
+
+def technique_whitelist_perfect_over_time(results):
+    # the fraction of sites without false positives at each load index
+    return [x[0] for x in binned_false_positive_rate(results)]
 
 ###
 # Database Queries
 ###
 
 
+# test_res of fingerprints stored by fp_store, fp is then its directory
+COLUMNAR = "columnar"
+
+
 def pickle_to_file(data, f_name):
     with open(f_name, 'wb') as out:
         pickle.dump(data, out)
@@ -774,21 +1286,23 @@ def store_fingerprints(
         results=None,
         path=None,
         verify=False):
-    """ Given a fingerprint convert it to json and store it as a string """
-    fp_copy = fingerprints
+    """
+    Store a fingerprint (and its test results) in the columnar format of
+    fp_store, the fingerprints table names the directory it is written to
+    inputs:
+        path: the directory, default fingerprints/<fp_id> next to the database
+    """
     fp_dtg = time.time()
-    fp_pick = pickle.dumps(fp_copy)
+    meta, columns, failures = fp_store.to_columns(fingerprints, results)
+    fp_id = fp_store.content_id(meta, columns, failures)
     if path is None:
-        res_pick = pickle.dumps(results)
-    else:
-        print "storing res to file"
-        res_pick = pickle.dumps(path)
-        pickle_to_file(results, path)
-    fp_id = str(hash(fp_pick))
-    n_limit = len(fp_copy)
-
-    data = (fp_id, name, n_limit, fp_pick, res_pick, fp_dtg)
-    # data = (fp_id, name, n_limit, fp_pick, None, fp_dtg)
+        db_dir = os.path.dirname(storage.database_file())
+        path = os.path.join(db_dir, "fingerprints", fp_id)
+    if not fp_store.exists(path):
+        fp_store.save(path, meta, columns, failures)
+    n_limit = len(fingerprints)
+
+    data = (fp_id, name, n_limit, path, COLUMNAR, fp_dtg)
     q = "INSERT OR IGNORE INTO fingerprints VALUES (?,?,?,?,?,?)"
     storage.execute(q, data)
     print "Stored: {} : {}".format(name, fp_id)
@@ -807,7 +1321,12 @@ def store_fingerprints(
 
 
 def load_fingerprint(name, fp_id=None, from_file=None):
-    """ Given a fingerprint id load the stored data and test resutls """
+    """
+    Given a fingerprint id load the stored data and test resutls
+    Columnar fingerprints are read lazily, a site at a time (see fp_store),
+    fingerprints pickled by earlier versions are loaded whole.
+    from_file: the pickled results were stored in the file test_res names
+    """
     if fp_id:
         q = "SELECT fp, test_res FROM fingerprints WHERE fp_id == '{}'".format(
                 fp_id)
@@ -816,6 +1335,9 @@ def load_fingerprint(name, fp_id=None, from_file=None):
         q = "SELECT fp, test_res FROM fingerprints WHERE fp_name == ?"
         row = storage.execute(q, (name,)).fetchone()
 
+    if row["test_res"] == COLUMNAR:
+        return fp_store.load(row["fp"])
+
     fp = pickle.loads(row["fp"])
     res = pickle.loads(row["test_res"])
     if from_file:
@@ -832,12 +1354,7 @@ def get_all_urls():
 
 
 def get_pages_for_url_time_orderd(url):
-    q = "SELECT page_id, start_time FROM pages "\
-        "WHERE har_status == 'success' "\
-        "AND url == '{}'"\
-        "order by start_time ASC".format(url)
-    pages = storage.execute(q).fetchall()
-    return pages
+    return storage.get("success_pages_for_url", (url,))
 
 
 def get_requests_for_page_id(page_id):
@@ -846,3 +1363,69 @@ def get_requests_for_page_id(page_id):
         "WHERE  page_id == '{}'".format(page_id)
     req = storage.execute(q).fetchall()
     return req
+
+
+class PageLoad(namedtuple("PageLoad", ["page_id", "start_time"])):
+    """ (page_id, start_time) of a load, also indexed by column name """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+
+GET_SUCCESS_URLS_ORDERED = "SELECT DISTINCT url FROM pages "\
+                           "WHERE har_status == 'success' ORDER BY url"
+
+# sites are bound in the query below this, otherwise filtered as they stream
+MAX_BOUND_SITES = 500
+
+
+def iter_site_loads(sites=None):
+    """
+    Yield (site_url, req_data) for each site with a successful load, where
+    req_data is the time ordered list of (PageLoad, [requests]) that the
+    fingerprint and test functions take.
+
+    Replaces a get_pages_for_url_time_orderd and get_requests_for_page_id
+    query per site and load: the successful loads and their requests are
+    streamed in the same (url, start_time, page_id) order, one site at a
+    time, and merged.  Requests are all of their columns (SELECT *).
+
+    sites: only yield these sites (optional)
+    """
+    where = "p.har_status == 'success'"
+    args = ()
+    if sites is not None:
+        sites = set(sites)
+        if len(sites) <= MAX_BOUND_SITES:
+            where += " AND p.url IN ({})".format(",".join("?"*len(sites)))
+            args = tuple(sites)
+        elif sites:
+            where += " AND p.url BETWEEN ? AND ?"
+            args = (min(sites), max(sites))
+    order = "p.url, p.start_time, p.page_id"
+
+    q = "SELECT p.url, p.page_id, p.start_time FROM pages AS p "\
+        "WHERE {} ORDER BY {}".format(where, order)
+    pages = storage.iterate(q, args, row_type=tuple)
+
+    # requests of a load in insertion order, as when queried by page_id
+    req_order = order if storage.normalized() else order + ", r.rowid"
+    q = "SELECT r.* FROM pages AS p "\
+        "JOIN requests AS r ON r.page_id == p.page_id "\
+        "WHERE {} ORDER BY {}".format(where, req_order)
+    requests = storage.iterate(q, args)
+    req = next(requests, None)
+
+    for site_url, loads in groupby(pages, key=itemgetter(0)):
+        req_data = []
+        for _, page_id, start_time in loads:
+            load_req = []
+            while req is not None and req["page_id"] == page_id:
+                load_req.append(req)
+                req = next(requests, None)
+            req_data.append((PageLoad(page_id, start_time), load_req))
+        if sites is None or site_url in sites:
+            yield site_url, req_data
@@ -0,0 +1,253 @@
+"""Streaming HAR Reader
+
+Incrementally scans a HAR file and yields just the entry fields needed to
+build a storage.Request.  The file is read in fixed size chunks so that large
+captures (eg: with response content) are never fully materialized, response
+text is hashed (see text_hash) as it streams past.
+"""
+
+import hashlib
+import json
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# a run of string content including escape sequences
+STRING_RUN = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.S)
+NUMBER = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?')
+LITERALS = {"true": True, "false": False, "null": None}
+# an escape sequence in a string, surrogate pairs as one
+ESCAPE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}'
+                    r'\\u[dD][c-fC-F][0-9a-fA-F]{2}'
+                    r'|\\u[0-9a-fA-F]{4}|\\.', re.S)
+# longest escape sequence (a surrogate pair)
+MAX_ESCAPE = 12
+
+
+def text_hash(text):
+    """ The content_hash of a (decoded) response text, sha1 of its utf-8 """
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return hashlib.sha1(text).hexdigest()
+
+
+def _unescape(raw):
+    """ The utf-8 of the raw (escaped, utf-8) contents of a JSON string """
+    return ESCAPE.sub(
+        lambda m: json.loads('"' + m.group() + '"').encode("utf-8"), raw)
+
+
+class HarScanner(object):
+    """Minimal pull based JSON scanner over a file object
+
+    The caller walks the document with object_items/array_items and must
+    consume (value, skip or string_chunks) every value it is handed.
+    """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, need=1):
+        """Ensure at least need unread characters are buffered (if possible)"""
+        while len(self.buf) - self.pos < need and not self.eof:
+            data = self.f.read(self.chunk_size)
+            if not data:
+                self.eof = True
+            self.buf = self.buf[self.pos:] + data
+            self.pos = 0
+        return len(self.buf) - self.pos >= need
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of HAR")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '{}' at {}".format(char, self.pos))
+        self.pos += 1
+
+    def string_chunks(self):
+        """Yield the raw (still escaped) contents of the next string"""
+        self.expect('"')
+        while True:
+            end = STRING_RUN.match(self.buf, self.pos).end()
+            if end > self.pos:
+                yield self.buf[self.pos:end]
+            self.pos = end
+            if self.pos >= len(self.buf) or self.buf[self.pos] == '\\':
+                # the run, or an escape sequence, continues in the next chunk
+                if not self._fill(2):
+                    raise ValueError("Unterminated string in HAR")
+                continue
+            # closing quote
+            self.pos += 1
+            return
+
+    def string(self):
+        raw = "".join(self.string_chunks())
+        return json.loads('"' + raw + '"')
+
+    def hash_string(self):
+        """text_hash of the next string without holding it in memory"""
+        digest = hashlib.sha1()
+        held = ""
+        for chunk in self.string_chunks():
+            raw = held + chunk
+            # a \u escape at the end may continue in the next chunk (or be
+            # the first half of a surrogate pair)
+            cut = len(raw)
+            for m in ESCAPE.finditer(raw):
+                if m.start() >= len(raw) - MAX_ESCAPE and \
+                        m.group().startswith("\\u"):
+                    cut = m.start()
+                    break
+            digest.update(_unescape(raw[:cut]))
+            held = raw[cut:]
+        digest.update(_unescape(held))
+        return digest.hexdigest()
+
+    def scalar(self):
+        char = self.peek()
+        if char == '"':
+            return self.string()
+        # numbers and literals are short, make sure the whole token is here
+        self._fill(32)
+        match = NUMBER.match(self.buf, self.pos)
+        if match:
+            self.pos = match.end()
+            return json.loads(match.group())
+        for literal, value in LITERALS.iteritems():
+            if self.buf.startswith(literal, self.pos):
+                self.pos += len(literal)
+                return value
+        raise ValueError("Invalid value at {}".format(self.pos))
+
+    def object_items(self):
+        """Yield the keys of the next object, the value must be consumed"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.string()
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            elif char != ',':
+                raise ValueError("Expected ',' or '}}' at {}".format(self.pos))
+
+    def array_items(self):
+        """Yield once per item of the next array, the item must be consumed"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            elif char != ',':
+                raise ValueError("Expected ',' or ']' at {}".format(self.pos))
+
+    def value(self):
+        """Parse the next value in full (only for small values)"""
+        char = self.peek()
+        if char == '{':
+            return dict((k, self.value()) for k in self.object_items())
+        elif char == '[':
+            return [self.value() for _ in self.array_items()]
+        return self.scalar()
+
+    def skip(self):
+        char = self.peek()
+        if char == '{':
+            for _ in self.object_items():
+                self.skip()
+        elif char == '[':
+            for _ in self.array_items():
+                self.skip()
+        elif char == '"':
+            for _ in self.string_chunks():
+                pass
+        else:
+            self.scalar()
+
+
+def _read_entry(scanner):
+    """Pull the request relevant fields out of a single HAR entry"""
+    entry = {"pageref": None, "startedDateTime": None, "url": None,
+             "status": None, "content_hash": None,
+             "request": False, "response": False}
+    for key in scanner.object_items():
+        if key in ("pageref", "startedDateTime"):
+            entry[key] = scanner.value()
+        elif key == "request" and scanner.peek() == '{':
+            for r_key in scanner.object_items():
+                entry["request"] = True
+                if r_key == "url":
+                    entry["url"] = scanner.string()
+                else:
+                    scanner.skip()
+        elif key == "response" and scanner.peek() == '{':
+            for r_key in scanner.object_items():
+                entry["response"] = True
+                if r_key == "status":
+                    entry["status"] = scanner.scalar()
+                elif r_key == "content" and scanner.peek() == '{':
+                    for c_key in scanner.object_items():
+                        if c_key == "text" and scanner.peek() == '"':
+                            entry["content_hash"] = scanner.hash_string()
+                        else:
+                            scanner.skip()
+                else:
+                    scanner.skip()
+        else:
+            scanner.skip()
+    return entry
+
+
+def iter_entries(f, chunk_size=CHUNK_SIZE):
+    """Yield the entries of a HAR file object one at a time
+
+    Each entry is a small dict of: pageref, startedDateTime, url, status,
+    content_hash (text_hash of the response text) and whether the request and
+    response were present.  Entries that do not belong to one of the HAR
+    pages are skipped.
+    """
+    scanner = HarScanner(f, chunk_size)
+    page_ids = None
+    for key in scanner.object_items():
+        if key != "log":
+            scanner.skip()
+            continue
+        for log_key in scanner.object_items():
+            if log_key == "pages":
+                page_ids = set()
+                for _ in scanner.array_items():
+                    page = scanner.value()
+                    page_ids.add(page.get("id"))
+            elif log_key == "entries":
+                for _ in scanner.array_items():
+                    entry = _read_entry(scanner)
+                    if entry["pageref"] is None:
+                        continue
+                    if page_ids is not None and \
+                            entry["pageref"] not in page_ids:
+                        continue
+                    yield entry
+            else:
+                scanner.skip()
@@ -1,10 +1,16 @@
 import itertools
+import multiprocessing
 import operator
+import os
+import random
 import timeit
 
+import numpy as np
+
 from carl import analysis
 from carl import charts
 from carl import common
+from carl import minhash
 from carl import storage
 from carl import utils
 
@@ -15,41 +21,96 @@ def get_all_urls():
 
     Return a list of tuples containing a url and the number of successful loads
     """
-    q = "SELECT url, count(url) FROM pages "\
-        "WHERE har_status == 'success' GROUP BY url"
-    rows = storage.execute(q).fetchall()
-    return [(u[0], u[1]) for u in rows]
+    return list(storage.stream("success_urls", row_type=tuple))
+
+
+LOAD_SETS_Q = "SELECT p.url, p.page_id, p.start_time, r.req_id, {cols} "\
+              "FROM pages AS p {join} {table} AS r "\
+              "ON r.page_id == p.page_id {where}"\
+              "ORDER BY p.url, p.page_id"
+
+
+def iter_page_load_sets(views=common.VIEWS, where=None, args=(), ids=False,
+                        all_pages=False, empty_values=False):
+    """Stream the load set of every view for each page load in one pass
+
+    Yield (url, load_id, time, load_sets) ordered by url then load_id, where
+    load_sets maps each view to the set of its values in the load's requests
 
+    where - optional condition on pages (p) and requests (r), with args
+    ids - on a normalized database use the interned integer ids, useful
+          when only the set sizes matter
+    all_pages - include loads without any requests (with empty sets)
+    empty_values - keep empty values in the sets as None (as jaccard does),
+                   by default NULL values are left out
+    """
+    if ids and storage.normalized():
+        table = storage.request_table()
+        cols = [storage.id_column(v) for v in views]
+    else:
+        table = "requests"
+        cols = views
+    q = LOAD_SETS_Q.format(
+        cols=", ".join("r.{}".format(c) for c in cols),
+        join="LEFT JOIN" if all_pages else "JOIN", table=table,
+        where="WHERE {} ".format(where) if where else "")
+
+    rows = storage.iterate(q, args, row_type=tuple)
+    for load, reqs in itertools.groupby(rows, key=operator.itemgetter(0, 1, 2)):
+        load_sets = [set() for _ in views]
+        for row in reqs:
+            # no requests (all_pages)
+            if row[3] is None:
+                continue
+            for load_set, value in zip(load_sets, row[4:]):
+                if empty_values:
+                    load_set.add(value or None)
+                elif value is not None:
+                    load_set.add(value)
+        yield load + (dict(zip(views, load_sets)),)
+
+
+def get_load_lists(views=common.VIEWS, where=None, args=(), ids=False,
+                   all_pages=False, empty_values=False):
+    """Group the load sets of each view into "load lists" by url
+
+    Return Dictionary keyed by view, then url
+    Where the value is a list of tuples containing: (load_id, time, load_set)
+    load_id: the unique id for this page load
+    time: when it was captured
+    load_set: the set of view elements present in this loads requests
 
-def get_all_load_sets(view=common.VIEWS[0]):
+    See iter_page_load_sets for the arguments.
+    """
+    load_lists = {v: {} for v in views}
+    for url, load_id, dtg, load_sets in iter_page_load_sets(
+            views, where, args, ids, all_pages, empty_values):
+        for v in views:
+            data = (load_id, dtg, load_sets[v])
+            load_lists[v].setdefault(url, []).append(data)
+    return load_lists
+
+
+def get_all_load_sets(view=common.VIEWS[0], ids=False):
     """Query all captured requests and group the request view
 
     defaults to the most coarse grained view 'priv/etld'
-    """
-    q = "SELECT p.url, p.page_id, p.start_time, "\
-        "GROUP_CONCAT(DISTINCT r.{}) "\
-        "FROM pages as p JOIN requests AS r "\
-        "ON r.page_id == p.page_id "\
-        "GROUP BY p.page_id".format(view)
 
+    ids - on a normalized database build the load sets from the interned
+          integer ids, useful when only the set sizes matter
+    """
     start = timeit.default_timer()
-    rows = storage.execute(q).fetchall()
+    load_sets = get_load_lists([view], ids=ids)[view]
     print("query took: {}".format(timeit.default_timer() - start))
-    return rows_to_load_sets(rows)
+    return load_sets
 
 
 def get_no_ads__load_sets():
-    q = "SELECT p.url, p.page_id, p.start_time, "\
-        "GROUP_CONCAT(DISTINCT r.priv) "\
-        "FROM pages as p JOIN requests AS r "\
-        "ON r.page_id == p.page_id "\
-        "WHERE r.ad == 0 "\
-        "GROUP BY p.page_id"\
-
     start = timeit.default_timer()
-    rows = storage.execute(q).fetchall()
+    view = common.VIEWS[0]
+    load_sets = get_load_lists([view], "r.ad == 0")[view]
     print("query took: {}".format(timeit.default_timer() - start))
-    return rows_to_load_sets(rows)
+    return load_sets
 
 
 def get_url_load_set(url, view=common.VIEWS[0]):
@@ -57,33 +118,7 @@ def get_url_load_set(url, view=common.VIEWS[0]):
 
     defaults to the most coarse grained view 'priv/etld'
     """
-    q = "SELECT p.url, p.page_id, p.start_time, "\
-        "GROUP_CONCAT(DISTINCT r.{}) "\
-        "FROM pages as p JOIN requests AS r "\
-        "ON r.page_id == p.page_id "\
-        "WHERE p.url == '{}' "\
-        "GROUP BY p.page_id".format(view, url)
-    rows = storage.execute(q).fetchall()
-    return rows_to_load_sets(rows)[url]
-
-
-def rows_to_load_sets(rows):
-    """ Given rows queried from database generate "load_sets"
-
-    Return Dictionary keyed by url
-    Where the value is a list of tuples containing: (load_id, time, load_set)
-    load_id: the unique id for this page load
-    time: when it was captured
-    load_set: the set of view elements present in this loads requests
-    """
-    all_loads_sets = {}
-    for r in rows:
-        url, load_id, dtg, load_set_str = r
-        load_set = set(load_set_str.split(','))
-        data = (load_id, dtg, load_set)
-        all_loads_sets.setdefault(url, []).append(data)
-
-    return all_loads_sets
+    return get_load_lists([view], "p.url == ?", (url,))[view][url]
 
 
 def sort_load_list_by_time(load_list):
@@ -251,26 +286,377 @@ def sumarize_load_list(load_list):
     return results
 
 
-def compute_over_all_urls():
-    """Run all the calculations over all the urls
+# Vectorized calculations
+def encode_load_list(load_list):
+    """Compact form of a load list, cheap to pass to worker processes
+
+    Return (times, indptr, elements, num_elements) where the load sets are
+    numbered per url and concatenated into the int32 array elements, the
+    set of load i being elements[indptr[i]:indptr[i+1]].
+    """
+    columns = {}
+    indptr = [0]
+    elements = []
+    for load in load_list:
+        elements.extend(columns.setdefault(x, len(columns)) for x in load[2])
+        indptr.append(len(elements))
+    return ([load[1] for load in load_list], np.array(indptr, dtype=np.int32),
+            np.array(elements, dtype=np.int32), len(columns))
+
+
+def decode_matrix(encoded):
+    """The boolean load matrix and load times of an encoded load list"""
+    times, indptr, elements, num_elements = encoded
+    matrix = np.zeros((len(times), num_elements), dtype=bool)
+    rows = np.repeat(np.arange(len(times)), np.diff(indptr))
+    matrix[rows, elements] = True
+    return matrix, times
+
+
+def load_matrix(load_list):
+    """Encode the load_sets of a load list as a boolean matrix
+
+    Row i is load_list[i] and there is a column for every element in the
+    universe of the loads.
+    """
+    return decode_matrix(encode_load_list(load_list))[0]
+
+
+def _pair_jaccard(inter, sizes, a, b):
+    """Jaccard of the loads a[k], b[k] from the pairwise intersection sizes"""
+    return _jaccards(inter[a, b], sizes[a], sizes[b])
+
+
+def _jaccards(pair_inter, sizes_a, sizes_b):
+    """Jaccard of pairs of loads from their intersection and set sizes"""
+    union = sizes_a + sizes_b - pair_inter
+    # two loads without any values (successful loads without requests)
+    union = np.where(union == 0, np.inf, union)
+    return (pair_inter / union.astype(float)).tolist()
+
+
+def _universe_growth(matrix, order):
+    """Number of new elements each load adds when taken in order"""
+    # the first load (in order) containing each element
+    first = matrix[order].argmax(axis=0)
+    return np.bincount(first, minlength=len(order)).tolist()
+
+
+def sumarize_load_matrix(load_list):
+    """Same results as sumarize_load_list, computed with matrix operations
+
+    All pairwise intersection sizes come from a single product of the load
+    matrix with its transpose, unions follow from the load sizes.  Results
+    are accumulated in the same order as the set based calculations so the
+    values are identical.
+    """
+    return _sumarize_matrix(load_matrix(load_list),
+                            [load[1] for load in load_list])
+
+
+def _sumarize_matrix(matrix, times):
+    counts = matrix.astype(np.int32)
+    sizes = counts.sum(axis=1)
+    inter = counts.dot(counts.T)
+    # stable sorts, matching sort_load_list_by_time/size
+    by_time = sorted(range(len(times)), key=lambda i: times[i])
+    by_size = sorted(range(len(times)), key=lambda i: sizes[i])
+
+    results = {}
+    results['jac'] = int(matrix.all(axis=0).sum())/float(matrix.shape[1])
+    # same order as itertools.combinations
+    a, b = np.triu_indices(len(times), 1)
+    results['pair_jac'] = avg_list(_pair_jaccard(inter, sizes, a, b))
+    results['chron_jac'] = avg_list(_pair_jaccard(inter, sizes, by_time[:-1],
+                                                  by_time[1:]))
+    results['chron_univ'] = univ_calc(_universe_growth(matrix, by_time))
+    results['size_univ'] = univ_calc(_universe_growth(matrix, by_size))
+    return results
+
+
+def _map_task(task):
+    """Run one map_load_lists task, in a worker process when jobs > 1"""
+    start = timeit.default_timer()
+    key, func, args, encoded = task
+    matrix, times = decode_matrix(encoded)
+    result = func(matrix, times, *args)
+    return key, result, os.getpid(), timeit.default_timer() - start
+
+
+def map_load_lists(func, tasks, jobs=1):
+    """Apply func(matrix, times, *args) to the load list of every task
+
+    tasks - iterable of (key, args, load_list)
+    jobs - number of processes, load lists are sent to them encoded (see
+           encode_load_list) rather than as pickled sets
+
+    Yield (key, result) in the order of tasks and print the time spent by
+    each worker once done.
+    """
+    work = ((key, func, args, encode_load_list(load_list))
+            for key, args, load_list in tasks)
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(_map_task, work, chunksize=8)
+    else:
+        results = itertools.imap(_map_task, work)
+
+    start = timeit.default_timer()
+    workers = {}
+    try:
+        for key, result, pid, elapsed in results:
+            worker = workers.setdefault(pid, [pid, 0, 0.0])
+            worker[1] += 1
+            worker[2] += elapsed
+            yield key, result
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    print("computation took: {:.2f}s".format(
+        timeit.default_timer() - start))
+    analysis.print_tabulated(sorted(workers.values()),
+                             ["worker", "urls", "seconds"])
+
+
+def summarize_load_lists(url_load_lists, jobs=1):
+    """sumarize_load_matrix for every url, ordered by url
 
     Return a list of dictionaries representing each url
     """
+    tasks = ((url, (), load_list)
+             for url, load_list in sorted(url_load_lists.iteritems()))
     results = []
-    url_load_lists = get_all_load_sets()
-    start = timeit.default_timer()
-    for url, load_list in url_load_lists.iteritems():
-        res = sumarize_load_list(load_list)
+    for url, res in map_load_lists(_sumarize_matrix, tasks, jobs):
         res["url"] = url
-        res["loads"] = len(load_list)
+        res["loads"] = len(url_load_lists[url])
+        results.append(res)
+    return results
+
+
+def compute_over_all_urls(approx=None, jobs=1):
+    """Run all the calculations over all the urls
+
+    approx - estimate the metrics from MinHash signatures, within this error
+             (eg: 0.05), instead of computing them exactly (see minhash)
+    jobs - number of processes used to bring url_stats up to date
+
+    Return a list of dictionaries representing each url
+    """
+    if approx:
+        return minhash.compute_over_all_urls(error=approx)
+    ensure_url_stats(jobs=jobs)
+    return read_url_stats()
+
+
+def compute_from_load_sets(jobs=1):
+    """Compute every metric from scratch, see compute_over_all_urls"""
+    # only the set sizes are reported, so use interned ids when available
+    return summarize_load_lists(get_all_load_sets(ids=True), jobs)
+
+
+##
+# Materialized per url statistics
+#
+# url_stats holds the state behind each metric for every url, view and
+# population of loads, and url_stats_pages the loads that have been counted.
+# update_url_stats runs at the end of make_db (analysis.load_dir_to_db) and
+# only revisits urls with loads that are not counted yet: new loads, loads
+# whose requests arrived later and loads make_db replaced (see
+# analysis._forget_pages).  The pairwise sums, which are quadratic in the
+# number of loads, are extended with the pairs of the new loads only, unless
+# a load that was counted changed and the url is counted again.  Everything
+# else is linear and is recomputed from the url's loads.  Reads only look the
+# rows up.
+##
+
+# the loads counted by each population, as iter_page_load_sets arguments
+URL_STATS_POPULATIONS = {
+    # the jac3 metrics: every load with requests, without empty values
+    "loads": {"where": None, "all_pages": False, "empty_values": False},
+    # jaccard: every successful load, keeping empty values (as None)
+    "success": {"where": "p.har_status == 'success'", "all_pages": True,
+                "empty_values": True}}
+
+DELETE_STATS_Q = "DELETE FROM url_stats "\
+                 "WHERE url == ? AND view == ? AND population == ?"
+
+NEW_PAGES_Q = "SELECT p.page_id, p.url FROM pages AS p "\
+              "WHERE NOT EXISTS (SELECT 1 FROM url_stats_pages AS s "\
+              "WHERE s.page_id == p.page_id)"
+
+
+def _url_stats_values(matrix, times, stats=None, ranks=None):
+    """ url_stats values (after url and view) for a url's load matrix
+
+    stats - the url's previous loads, pair_sum and pair_count, the pairwise
+            sums are extended with the pairs of the loads after those already
+            counted
+    ranks - the position of each load in load_id order, which breaks ties
+            in time and size as in a recompute (default: already in order)
+    """
+    counts = matrix.astype(np.int32)
+    sizes = counts.sum(axis=1)
+    loads = len(times)
+    if ranks is None:
+        ranks = range(loads)
+    by_time = sorted(range(loads), key=lambda i: (times[i], ranks[i]))
+    by_size = sorted(range(loads), key=lambda i: (sizes[i], ranks[i]))
+
+    if stats:
+        # the new loads are at the end, only the intersections of each of
+        # them with every load are needed
+        old = stats["loads"]
+        inter = counts[old:].dot(counts.T)
+        # the pairs (a, b) with b new, in itertools.combinations order
+        a, b = np.meshgrid(np.arange(loads), np.arange(old, loads),
+                           indexing="ij")
+        pairs = a < b
+        a, b = a[pairs], b[pairs]
+        pair_sum = stats["pair_sum"] + sum(
+            _jaccards(inter[b - old, a], sizes[a], sizes[b]))
+        pair_count = stats["pair_count"] + len(a)
+    else:
+        # same order as itertools.combinations
+        a, b = np.triu_indices(loads, 1)
+        pair_sum = sum(_pair_jaccard(counts.dot(counts.T), sizes, a, b))
+        pair_count = len(a)
+    first, second = by_time[:-1], by_time[1:]
+    chron = _jaccards((matrix[first] & matrix[second]).sum(axis=1),
+                      sizes[first], sizes[second])
+
+    return [loads, int(matrix.any(axis=0).sum()),
+            int(matrix.all(axis=0).sum()), pair_sum, pair_count, sum(chron),
+            len(chron), univ_calc(_universe_growth(matrix, by_time)),
+            univ_calc(_universe_growth(matrix, by_size))]
+
+
+def _url_stats_tasks(urls, views, new_pages):
+    """ map_load_lists tasks bringing the url_stats of urls up to date """
+    q = "SELECT loads, pair_sum, pair_count FROM url_stats "\
+        "WHERE url == ? AND view == ? AND population == ?"
+    for url in urls:
+        for population, params in sorted(URL_STATS_POPULATIONS.items()):
+            where = "p.url == ?"
+            if params["where"]:
+                where = "{} AND {}".format(where, params["where"])
+            load_lists = get_load_lists(
+                views, where, (url,), all_pages=params["all_pages"],
+                empty_values=params["empty_values"])
+            for view in views:
+                load_list = load_lists[view].get(url)
+                # no loads in this population (eg: none successful), or no
+                # longer any once a page was replaced
+                if not load_list:
+                    storage.execute(DELETE_STATS_Q, (url, view, population))
+                    continue
+                stats = storage.execute(q, (url, view, population)).fetchone()
+                old = [l for l in load_list if l[0] not in new_pages]
+                ranks = None
+                if stats and stats["loads"] == len(old):
+                    rank = {l[0]: i for i, l in enumerate(load_list)}
+                    load_list = old + [l for l in load_list
+                                       if l[0] in new_pages]
+                    ranks = [rank[l[0]] for l in load_list]
+                    stats = dict(zip(stats.keys(), stats))
+                else:
+                    stats = None
+                yield (url, view, population), (stats, ranks), load_list
+
+
+def url_stats_current():
+    """ True if url_stats exists, with every population """
+    return storage.table_exists(storage.StatsPage.name) and \
+        "population" in storage.table_columns(storage.UrlStats.name)
+
+
+def update_url_stats(views=common.VIEWS, jobs=1):
+    """Bring url_stats up to date with any newly loaded pages
+
+    jobs - number of processes computing the statistics
+
+    Return the number of urls updated
+    """
+    if storage.table_exists(storage.UrlStats.name) and \
+            not url_stats_current():
+        # counted before the populations were kept apart, start over
+        for table in [storage.UrlStats, storage.StatsPage]:
+            storage.execute("DROP TABLE IF EXISTS {}".format(table.name))
+    for table in [storage.UrlStats(), storage.StatsPage()]:
+        storage.execute(table.schema())
+    new = list(storage.iterate(NEW_PAGES_Q, row_type=tuple))
+    if len(new) == 0:
+        return 0
+
+    new_pages = set(page_id for page_id, url in new)
+    urls = sorted(set(url for page_id, url in new))
+    # the queries run here while the workers compute
+    tasks = list(_url_stats_tasks(urls, views, new_pages)) if jobs > 1 \
+        else _url_stats_tasks(urls, views, new_pages)
+    rows = [list(key) + values for key, values in
+            map_load_lists(_url_stats_values, tasks, jobs)]
+    storage.store_rows(storage.UrlStats, rows, replace=True)
+    storage.store_rows(storage.StatsPage, [(p,) for p in new_pages])
+    print("url stats: {} urls updated".format(len(urls)))
+    return len(urls)
+
+
+def ensure_url_stats(jobs=1):
+    """ Count any loads make_db did not (eg: a database made before url_stats
+    was kept), otherwise url_stats is up to date and reads are lookups """
+    update_url_stats(jobs=jobs)
+
+
+def read_url_stats(view=common.VIEWS[0]):
+    """ The metrics of every url from url_stats, as in compute_from_load_sets
+    """
+    results = []
+    q = "SELECT * FROM url_stats WHERE view == ? AND population == 'loads'"
+    for row in storage.iterate(q, (view,)):
+        res = {}
+        res['jac'] = 0
+        if row["union_size"]:
+            res['jac'] = row["inter_size"]/float(row["union_size"])
+        res['pair_jac'] = 0
+        if row["pair_count"]:
+            res['pair_jac'] = row["pair_sum"]/float(row["pair_count"])
+        res['chron_jac'] = 0
+        if row["chron_count"]:
+            res['chron_jac'] = row["chron_sum"]/float(row["chron_count"])
+        res['chron_univ'] = row["chron_univ"]
+        res['size_univ'] = row["size_univ"]
+        res["url"] = row["url"]
+        res["loads"] = row["loads"]
         results.append(res)
-    print("computation took: {}".format(timeit.default_timer() - start))
     return results
 
 
 calc = ["jac", "pair_jac", "chron_jac", "chron_univ", "size_univ"]
 
 
+def approx_error(results, view=common.VIEWS[0], metrics=calc, sample=20):
+    """Measure approximate results against the exact metrics for a sample
+
+    results - list of dictionaries with a url and approximations of (some
+              of) the calc metrics, eg: compute_over_all_urls(approx=0.05)
+
+    Return the table rows [metric, mean error, max error] and headers
+    """
+    results = sorted(results, key=operator.itemgetter("url"))
+    if len(results) > sample:
+        results = random.Random(minhash.SEED).sample(results, sample)
+    errors = {m: [] for m in metrics}
+    for res in results:
+        exact = sumarize_load_matrix(get_url_load_set(res["url"], view))
+        for m in metrics:
+            errors[m].append(abs(exact[m] - res[m]))
+    table = []
+    for m in metrics:
+        table.append([m, avg_list(errors[m]), max(errors[m] or [0])])
+    return table, ["metric", "mean error", "max error"]
+
+
 def gen_jac_table():
     headers = ["url", "loads"] + calc
     data = compute_over_all_urls()
@@ -288,17 +674,8 @@ def print_summary():
     chart_summary(data)
 
 
-def with_no_ads():
-    no_ads = []
-
-    url_load_lists = get_no_ads__load_sets()
-    start = timeit.default_timer()
-    for url, load_list in url_load_lists.iteritems():
-        res = sumarize_load_list(load_list)
-        res["url"] = url
-        res["loads"] = len(load_list)
-        no_ads.append(res)
-    print("computation took: {}".format(timeit.default_timer() - start))
+def with_no_ads(jobs=1):
+    no_ads = summarize_load_lists(get_no_ads__load_sets(), jobs)
     chart_summary(no_ads)
 
 
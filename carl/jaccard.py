@@ -3,34 +3,54 @@ import operator
 
 from carl import charts
 from carl import common
+from carl import jac3
+from carl import minhash
 from carl import storage
-from carl.analysis import table_to_dict, map_items_to_parent, print_tabulated
+from carl.analysis import print_tabulated
 
 
 def gen_view_sets(pages):
     """ Generates the view_set for each page in pages"""
-    views = common.VIEWS
-    reqs = table_to_dict("req")
-    page_req_lists = map_items_to_parent(reqs, pages)
-    view_sets = {}
+    view_sets = _success_view_sets()
+    return {p: view_sets[p] for p in view_sets if p in pages}
+
 
-    for page_id, req_list in page_req_lists.iteritems():
-        # exclude any pages that did not successfully save a HAR file
-        if pages[page_id].data["har_status"] == "success":
-            # prep empty sets per page for each view
-            view_sets[page_id] = {}
-            for v in views:
-                view_sets[page_id][v] = set()
-            # accumulate requests per page by view
-            for r in req_list:
-                for v in views:
-                    view_sets[page_id][v].add(r.data[v])
+def gen_url_view_sets(url):
+    """ Generates the view_set for each page load of a single url
 
+    Only the url's requests are read (through the pages and requests indexes)
+    """
+    return _success_view_sets("p.url == ?", (url,))
+
+
+def _success_view_sets(where=None, args=()):
+    # exclude any pages that did not successfully save a HAR file
+    cond = "p.har_status == 'success'"
+    if where:
+        cond = "{} AND {}".format(where, cond)
+    view_sets = {}
+    for url, page_id, dtg, load_sets in jac3.iter_page_load_sets(
+            where=cond, args=args, all_pages=True, empty_values=True):
+        view_sets[page_id] = load_sets
     return view_sets
 
 
-def print_jaccard_by_url(verbose, filt):
-    data = jaccard_by_url()
+def print_jaccard_by_url(verbose, filt, approx=None):
+    """Print the jaccard of each url
+
+    verbose - print the load sets of each url, computed from scratch
+    approx - estimate the values from MinHash signatures within this error
+             (see approx_jaccard_by_url), verbose output is not available
+
+    Otherwise the values are read from the url_stats table (see jac3).
+    """
+    if approx:
+        data = approx_jaccard_by_url(approx)
+        verbose = False
+    elif verbose:
+        data = jaccard_by_url()
+    else:
+        data = stats_jaccard_by_url()
     if filt:
         data = filter_url_result(data)
 
@@ -52,11 +72,16 @@ def print_jaccard_by_url(verbose, filt):
             print("#"*40)
 
         # construct summary row
-        row = [url, len(page_set)]
+        row = [url, data[url]["loads"]]
         for view in views:
             view_jac = jac[view]
-            view_str = "{:.2f} ({})".format(
-                    view_jac["val"], len(view_jac["u"]))
+            if approx:
+                view_str = "~{:.2f}".format(view_jac["val"])
+            else:
+                union_size = view_jac.get("union_size")
+                if union_size is None:
+                    union_size = len(view_jac["u"])
+                view_str = "{:.2f} ({})".format(view_jac["val"], union_size)
             row.append(view_str)
         for view in views:
             row.append("{:.2f}".format(pair_jac[view]))
@@ -65,17 +90,29 @@ def print_jaccard_by_url(verbose, filt):
     table = sorted(table, key=operator.itemgetter(headers.index(views[0])))
     print_tabulated(table, headers)
 
+    if approx:
+        print("Measured error on a sample of urls")
+        table = []
+        for view in views:
+            results = [{"url": url, "jac": data[url]["jaccard"][view]["val"],
+                        "pair_jac": data[url]["pair_jaccard"][view]}
+                       for url in data]
+            errors, err_headers = jac3.approx_error(
+                results, view, ["jac", "pair_jac"])
+            table += [[view] + row for row in errors]
+        print_tabulated(table, ["view"] + err_headers)
+
 
 def filter_url_result(results):
     sizes = {}
     for url in results:
-        sizes[url] = len(results[url]["page_set"])
+        sizes[url] = results[url]["loads"]
     max_size = max(sizes.values())
 
     valid = {}
     invalid = {}
     for url in results:
-        num_loads = len(results[url]["page_set"])
+        num_loads = results[url]["loads"]
         if num_loads >= max_size/2.0 and num_loads > 1:
             valid[url] = results[url]
         else:
@@ -90,27 +127,24 @@ def filter_url_result(results):
 
 
 def jaccard_by_url():
-    # collect necessary data
-    pages = table_to_dict("page")
-    page_sets = gen_view_sets(pages)
-    urls = storage.get("urls")
-
     # initialize data structures
     page_set_by_url = {}
     result = {}
-    for u in urls:
+    for u in storage.get("urls"):
         url = u["url"]
         page_set_by_url[url] = {}
         result[url] = {"page_set": None, "jaccard": None}
 
-    # group page_sets by url
-    for page_id, view_set in page_sets.iteritems():
-        url = pages[page_id].data["url"]
+    # group the view_sets of successful page loads by url
+    for url, page_id, dtg, view_set in jac3.iter_page_load_sets(
+            where="p.har_status == 'success'", all_pages=True,
+            empty_values=True):
         page_set_by_url[url][page_id] = view_set
 
     # calculate the jaccard across each page set
     for url, page_set in page_set_by_url.iteritems():
         result[url]["page_set"] = page_set
+        result[url]["loads"] = len(page_set)
         jac = calculate_jaccard_over_pages(page_set)
         result[url]["jaccard"] = jac
         # calculate jaccard across all pairs of loads
@@ -123,6 +157,65 @@ def jaccard_by_url():
     return result
 
 
+def stats_jaccard_by_url():
+    """The jaccard and pairwise jaccard of each url from url_stats
+
+    As with jaccard_by_url, the successful loads of every url (including
+    those without requests, and empty values) are counted.  There are no load
+    sets, just the number of loads and the size of each view's union.
+    """
+    jac3.ensure_url_stats()
+    # urls without any successful loads
+    result = {}
+    for u in storage.get("urls"):
+        result[u["url"]] = {
+            "page_set": None,
+            "loads": 0,
+            "jaccard": {v: {"val": 0, "union_size": 0} for v in common.VIEWS},
+            "pair_jaccard": {v: 0 for v in common.VIEWS}}
+
+    q = "SELECT url, view, loads, union_size, inter_size, pair_sum, "\
+        "pair_count FROM url_stats WHERE population == 'success'"
+    for row in storage.iterate(q, row_type=tuple):
+        url, view, loads, union_size, inter_size, pair_sum, pair_count = row
+        result.setdefault(url, {
+            "page_set": None,
+            "jaccard": {},
+            "pair_jaccard": {}})
+        result[url]["loads"] = loads
+        result[url]["jaccard"][view] = {
+            "val": inter_size/float(union_size) if union_size else 0,
+            "union_size": union_size}
+        result[url]["pair_jaccard"][view] = \
+            pair_sum/float(pair_count) if pair_count else 0
+    return result
+
+
+def approx_jaccard_by_url(error=minhash.DEFAULT_ERROR):
+    """Estimate the jaccard and pairwise jaccard of each url with MinHash
+
+    Unlike jaccard_by_url no load sets are built, page_set is just the ids
+    of the loads.  As with jac3, every load with requests is included and
+    empty values are not part of a load's set.
+    """
+    k = minhash.num_hashes(error)
+    result = {}
+    for view in common.VIEWS:
+        minhash.update_signatures(view, k)
+        for url, ids, times, sizes, sigs in \
+                minhash.iter_url_signatures(view, k):
+            if url not in result:
+                result[url] = {
+                    "page_set": ids,
+                    "loads": len(ids),
+                    "jaccard": {v: {"val": 0} for v in common.VIEWS},
+                    "pair_jaccard": {v: 0 for v in common.VIEWS}}
+            result[url]["jaccard"][view]["val"] = minhash.approx_jaccard(sigs)
+            result[url]["pair_jaccard"][view] = \
+                minhash.approx_pairwise_jaccard(sigs)
+    return result
+
+
 def calculate_jaccard_over_pages(page_sets):
     views = common.VIEWS
     jaccard = {}
@@ -144,7 +237,8 @@ def calculate_jaccard_over_pages(page_sets):
         if len(page_sets) > 0:
             i = len(jaccard[view]["i"])
             u = len(jaccard[view]["u"])
-            jaccard[view]["val"] = (float(i)/float(u))
+            # loads without requests have nothing in common
+            jaccard[view]["val"] = (float(i)/float(u)) if u else 0
         else:
             jaccard[view] = {"i": set(), "u": set(), "val": 0}
 
@@ -245,13 +339,7 @@ def print_page_set_view(pages, jac, view):
 def inspect_url(url):
     if not url.startswith("http"):
         url = "http://{}".format(url)
-    page_rows = storage.get("pages_for_url", (url,))
-    pages = {}
-    for row in page_rows:
-        item = storage.ITEMS["page"].from_sql_row(row)
-        pages[item.data["page_id"]] = item
-
-    view_sets = gen_view_sets(pages)
+    view_sets = gen_url_view_sets(url)
     print_page_set_cardinality(view_sets)
 
     jac = calculate_jaccard_over_pages(view_sets)
@@ -0,0 +1,194 @@
+"""MinHash Signatures
+
+Approximate versions of the jac3 metrics for crawls where the exact set math
+is too slow or too large to hold in memory.  Each page load's set of view
+elements (eg: the priv domains it requested) is reduced to a signature, the
+minimum of num_hashes random hash functions over the set.  The fraction of
+hash functions on which two signatures agree estimates their jaccard.
+
+Signatures are computed on first use and cached in the signatures table
+(keyed by page, view and number of hashes) so later runs only hash new loads.
+"""
+
+import itertools
+import math
+import sqlite3
+import timeit
+import zlib
+
+import numpy as np
+
+from carl import common
+from carl import storage
+
+# hash functions are (a*x + b) mod PRIME, seeded so cached signatures stay
+# comparable between runs
+SEED = 0x6361726c
+PRIME = (1 << 31) - 1
+DEFAULT_ERROR = 0.05
+
+
+def num_hashes(error=DEFAULT_ERROR):
+    """Number of hash functions needed to estimate jaccard within error
+
+    The estimate of a jaccard J has a standard deviation of
+    sqrt(J(1-J)/k) <= 1/(2 sqrt(k)), so k = 1/error^2 keeps it within error
+    about 95% of the time.
+    """
+    return int(math.ceil(1.0 / error**2))
+
+
+def hash_params(k):
+    rand = np.random.RandomState(SEED)
+    a = rand.randint(1, PRIME, k).astype(np.int64)
+    b = rand.randint(0, PRIME, k).astype(np.int64)
+    return a[:, None], b[:, None]
+
+
+def element_hashes(values):
+    return np.array([zlib.crc32(unicode(v).encode("utf-8")) % PRIME
+                     for v in values], dtype=np.int64)
+
+
+def signature(values, params):
+    """The minimum of every hash function over the set of values"""
+    a, b = params
+    x = element_hashes(values)
+    return ((a * x + b) % PRIME).min(axis=1).astype(np.uint32)
+
+
+# requests of the loads without a signature, loads without any values never
+# get one so they are left out rather than revisited on every update
+MISSING_Q = "SELECT r.page_id, r.{view} FROM requests AS r "\
+            "WHERE r.{view} IS NOT NULL AND NOT EXISTS ("\
+            "SELECT 1 FROM signatures AS s WHERE s.page_id == r.page_id "\
+            "AND s.view == ? AND s.num_hashes == ?) ORDER BY r.page_id"
+
+
+def update_signatures(view, k):
+    """Compute and store signatures for any loads not yet in the cache
+
+    As with jac3 load sets, empty values are not part of a load's set.
+    Return the number of new signatures.
+    """
+    storage.execute(storage.Signature().schema())
+    rows = storage.iterate(MISSING_Q.format(view=view), (view, k),
+                           row_type=tuple)
+    try:
+        first = next(rows)
+    except StopIteration:
+        return 0
+    rows = itertools.chain([first], rows)
+    params = hash_params(k)
+
+    start = timeit.default_timer()
+    batch = []
+    added = 0
+    for page_id, reqs in itertools.groupby(rows, key=lambda r: r[0]):
+        values = set(r[1] for r in reqs)
+        sig = signature(values, params)
+        batch.append((page_id, view, k, len(values),
+                      sqlite3.Binary(sig.tostring())))
+        if len(batch) >= 1000:
+            added += storage.store_rows(storage.Signature, batch)
+            batch = []
+    added += storage.store_rows(storage.Signature, batch)
+    print("signatures: {} new in {:.2f}s".format(
+        added, timeit.default_timer() - start))
+    return added
+
+
+def iter_url_signatures(view, k):
+    """Yield (url, load_ids, times, sizes, signatures) one url at a time
+
+    Loads are in page_id order, as in jac3 load lists, and the signatures
+    are an (loads x k) array.
+    """
+    q = "SELECT p.url, s.page_id, p.start_time, s.size, s.sig "\
+        "FROM signatures AS s JOIN pages AS p ON p.page_id == s.page_id "\
+        "WHERE s.view == ? AND s.num_hashes == ? "\
+        "ORDER BY p.url, s.page_id"
+    rows = storage.iterate(q, (view, k), row_type=tuple)
+    for url, loads in itertools.groupby(rows, key=lambda r: r[0]):
+        loads = list(loads)
+        sigs = np.vstack([np.frombuffer(bytes(l[4]), dtype=np.uint32)
+                          for l in loads])
+        yield (url, [l[1] for l in loads], [l[2] for l in loads],
+               [l[3] for l in loads], sigs)
+
+
+# Estimates, each takes the (loads x k) signature array
+def approx_jaccard(sigs):
+    """All loads share the union's minimum with probability |i|/|u|"""
+    return float(np.all(sigs == sigs[0], axis=0).mean())
+
+
+def approx_pairwise_jaccard(sigs):
+    """Average jaccard over every pair of loads
+
+    Counts the agreeing pairs for each hash function from runs of equal
+    values, rather than comparing every pair of signatures.
+    """
+    n, k = sigs.shape
+    if n < 2:
+        return 0
+    ordered = np.sort(sigs, axis=0)
+    pos = np.arange(n)[:, None]
+    new_run = np.ones(ordered.shape, dtype=bool)
+    new_run[1:] = ordered[1:] != ordered[:-1]
+    # each load agrees with the earlier loads in its run
+    run_start = np.maximum.accumulate(np.where(new_run, pos, 0), axis=0)
+    agree = int((pos - run_start).sum())
+    return agree / (k * n * (n - 1) / 2.0)
+
+
+def approx_chron_jaccard(sigs, order):
+    if len(order) < 2:
+        return 0
+    ordered = sigs[order]
+    return float((ordered[1:] == ordered[:-1]).mean())
+
+
+def approx_universe(sigs, order):
+    """Estimate univ_calc of the universe growth over loads in order
+
+    A load that adds nothing new to the universe never lowers its running
+    minimums, a load that does is detected unless none of its new elements
+    is the minimum of any hash function (unlikely for large k).
+    """
+    if len(order) < 2:
+        return 0
+    ordered = sigs[order]
+    running = np.minimum.accumulate(ordered, axis=0)
+    no_growth = np.all(ordered[1:] >= running[:-1], axis=1)
+    return int(no_growth.sum()) / float(len(order) - 1)
+
+
+def sumarize_signatures(times, sizes, sigs):
+    """Approximate jac3.sumarize_load_list"""
+    # stable sorts, matching jac3.sort_load_list_by_time/size
+    by_time = sorted(range(len(times)), key=lambda i: times[i])
+    by_size = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    results = {}
+    results['jac'] = approx_jaccard(sigs)
+    results['pair_jac'] = approx_pairwise_jaccard(sigs)
+    results['chron_jac'] = approx_chron_jaccard(sigs, by_time)
+    results['chron_univ'] = approx_universe(sigs, by_time)
+    results['size_univ'] = approx_universe(sigs, by_size)
+    return results
+
+
+def compute_over_all_urls(view=common.VIEWS[0], error=DEFAULT_ERROR):
+    """Approximate jac3.compute_over_all_urls, within error"""
+    k = num_hashes(error)
+    update_signatures(view, k)
+    results = []
+    start = timeit.default_timer()
+    for url, ids, times, sizes, sigs in iter_url_signatures(view, k):
+        res = sumarize_signatures(times, sizes, sigs)
+        res["url"] = url
+        res["loads"] = len(ids)
+        results.append(res)
+    print("computation took: {}".format(timeit.default_timer() - start))
+    return results
+
@@ -3,43 +3,125 @@
 Functionality for interacting with an sqlite3 database for analysis
 """
 import collections
+import itertools
 import logging
 import sqlite3
+import timeit
 
 from carl import utils
 
 # global connetion
 CONN = None
+# active bulk ingest session (if any), see BulkIngest
+BULK = None
+# default number of rows fetched per round trip when streaming results
+ARRAYSIZE = 1000
+
+
+class TableMeta(type):
+    """ Precomputes the column -> position index of each Table class """
+
+    def __init__(cls, name, bases, attrs):
+        super(TableMeta, cls).__init__(name, bases, attrs)
+        cls._index = dict((c, i) for i, c in enumerate(cls.cols))
+
+
+class TableData(object):
+    """ Dictionary style access to the values of a Table (Table.data)
+
+    Values live in a single list on the Table instance, this view only maps
+    column names to positions so no per instance dictionary is needed.
+    """
+    __slots__ = ("_table",)
+
+    def __init__(self, table):
+        self._table = table
+
+    def __getitem__(self, key):
+        return self._table._values[self._table._index[key]]
+
+    def __setitem__(self, key, value):
+        self._table._values[self._table._index[key]] = value
+
+    def __contains__(self, key):
+        return key in self._table._index
+
+    def __iter__(self):
+        return iter(self._table.cols)
+
+    def __len__(self):
+        return len(self._table.cols)
+
+    def __repr__(self):
+        return repr(collections.OrderedDict(self.items()))
+
+    def get(self, key, default=None):
+        if key in self._table._index:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self._table.cols)
+
+    def values(self):
+        return list(self._table._values)
+
+    def items(self):
+        return zip(self._table.cols, self._table._values)
+
+    def iteritems(self):
+        return itertools.izip(self._table.cols, self._table._values)
 
 
 class Table(object):
+    __metaclass__ = TableMeta
+    __slots__ = ("_values",)
+
     name = None
     pk = None
     cols = []
 
     def __init__(self, values=None):
-        self.data = collections.OrderedDict([(c, None) for c in self.cols])
+        self._values = [None] * len(self.cols)
         if values:
             self.from_dict(values)
 
+    @property
+    def data(self):
+        return TableData(self)
+
+    def __getstate__(self):
+        return self._values
+
+    def __setstate__(self, state):
+        self._values = state
+
     def from_dict(self, dictionary):
+        index = self._index
         for k, v in dictionary.iteritems():
-            if k in self.data:
-                self.data[k] = v
+            if k in index:
+                self._values[index[k]] = v
             else:
                 logging.debug("Key error creating {}: {}:{}".format(
                     self.name, k, v))
 
+    @classmethod
+    def row_type(cls):
+        """ Lightweight namedtuple of the table's columns for streaming """
+        if "_row_type" not in cls.__dict__:
+            cls._row_type = collections.namedtuple(cls.__name__ + "Row",
+                                                   cls.cols)
+        return cls._row_type
+
     @classmethod
     def from_sql_row(cls, row):
-        values = {}
-        for c in cls.cols:
-            if row[c]:
-                values[c] = row[c]
-        return cls(values)
+        item = cls()
+        # empty values are left as None
+        item._values = [row[c] or None for c in cls.cols]
+        return item
 
     def save_json(self, json_name):
-        utils.save_json(self.data, json_name)
+        utils.save_json(collections.OrderedDict(self.data.items()), json_name)
 
     def schema(self):
         schema = "CREATE TABLE IF NOT EXISTS {name} ({cols}, "\
@@ -57,6 +139,8 @@ class Table(object):
 
 
 class Run(Table):
+    __slots__ = ()
+
     name = "runs"
     pk = "run_id"
     cols = ['run_id', 'name', 'browser', 'num_urls', 'reloads', 'timeout',
@@ -74,14 +158,26 @@ class Run(Table):
 
 
 class Block(Table):
+    __slots__ = ("urls",)
+
     name = "block"
     pk = "num, run_id"
     cols = ['num', 'run_id', 'time']
 
-    urls = None
+    def __init__(self, values=None):
+        super(Block, self).__init__(values)
+        self.urls = None
+
+    def __getstate__(self):
+        return (self._values, self.urls)
+
+    def __setstate__(self, state):
+        self._values, self.urls = state
 
 
 class Page(Table):
+    __slots__ = ()
+
     name = "pages"
     pk = "page_id"
     cols = ['page_id', 'url', 'block_num', 'run_id', 'source', 'source_len',
@@ -90,34 +186,345 @@ class Page(Table):
 
 
 class Request(Table):
+    __slots__ = ()
+
     name = "requests"
     pk = "req_id"
     cols = ['req_id', 'page_id', 'status', 'scheme', 'etld', 'netloc', 'path',
             'query', 'content_hash', 'url', 'priv']
 
 
+class Domain(Table):
+    __slots__ = ()
+
+    name = "domains"
+    pk = "netloc"
+    cols = ['netloc', 'etld', 'priv']
+
+
+class Manifest(Table):
+    __slots__ = ()
+
+    name = "manifest"
+    pk = "path"
+    cols = ['path', 'size', 'mtime', 'digest']
+
+
+class Signature(Table):
+    __slots__ = ()
+
+    name = "signatures"
+    pk = "page_id, view, num_hashes"
+    cols = ['page_id', 'view', 'num_hashes', 'size', 'sig BLOB']
+
+
+class UrlStats(Table):
+    __slots__ = ()
+
+    name = "url_stats"
+    pk = "url, view, population"
+    cols = ['url', 'view', 'population', 'loads', 'union_size', 'inter_size',
+            'pair_sum', 'pair_count', 'chron_sum', 'chron_count', 'chron_univ',
+            'size_univ']
+
+
+class StatsPage(Table):
+    __slots__ = ()
+
+    name = "url_stats_pages"
+    pk = "page_id"
+    cols = ['page_id']
+
+
 class Fingerprint(Table):
+    __slots__ = ()
+
     name = "fingerprints"
     pk = "fp_id"
     cols = ['fp_id', 'fp_name', 'n_limit', 'fp BLOB', 'test_res BLOB',
             'dtg_gen']
 
 
-def connect_db(db_path="carl.sqlite3"):
+def connect_db(db_path="carl.sqlite3", read_only=False):
+    ''' Open the global connection
+
+    read_only - refuse any statement that would change the database, for
+                worker processes reading alongside the main one
+    '''
     global CONN
     CONN = sqlite3.connect(db_path)
     CONN.row_factory = sqlite3.Row
+    if read_only:
+        CONN.execute("PRAGMA query_only = 1")
+
+
+def database_file():
+    ''' Path of the database the global connection has open '''
+    return CONN.execute("PRAGMA database_list").fetchone()["file"]
 
 
-def initialize(db_path="carl.sqlite3"):
-    ''' Initialize the database '''
+def initialize(db_path="carl.sqlite3", indexes=True, layout="flat"):
+    ''' Initialize the database
+
+    indexes - create the indexes up front, a BulkIngest session defers this
+              until the load finishes
+    layout  - "flat" stores every request string in the requests table,
+              "normalized" interns the DIMENSIONS columns (see below)
+    '''
     connect_db(db_path)
-    for table in [Run(), Page(), Request(), Fingerprint()]:
+    for table in [Run(), Page(), Fingerprint(), Domain(), Manifest(),
+                  Signature(), UrlStats(), StatsPage()]:
         execute(table.schema())
 
-    # Perfomance related optomizations
-    q = "CREATE INDEX req_to_page ON requests (page_id)"
-    execute(q)
+    if layout == "normalized" and table_exists(Request.name, "table"):
+        logging.warning("Existing flat requests table, keeping flat layout")
+        layout = "flat"
+    if layout == "normalized" or normalized():
+        for q in normalized_schema():
+            execute(q)
+    else:
+        execute(Request().schema())
+
+    if indexes:
+        create_indexes()
+
+
+##
+# Managed indexes
+#
+# (name, table, columns) created once data is loaded, see create_indexes.
+# REQUESTS stands in for request_table().  The pages indexes cover the hot
+# lookups: successful loads of a url ordered by start time, the per url
+# grouping of successful loads, the loads of a url in page_id order
+# (jac3.iter_page_load_sets) and the per run counts (analysis.run_stats).
+# An index is skipped while one of its columns does not exist yet (eg:
+# requests.ad before ads.mark_ads has run).
+##
+REQUESTS = "{requests}"
+INDEXES = [("req_to_page", REQUESTS, ["page_id"]),
+           ("req_ad_to_page", REQUESTS, ["ad", "page_id", "priv"]),
+           ("page_url_status_time", Page.name,
+            ["url", "har_status", "start_time", "page_id"]),
+           ("page_url_load", Page.name, ["url", "page_id"]),
+           ("page_run_status", Page.name,
+            ["run_id", "get_status", "har_status", "url"]),
+           ("page_status_url", Page.name, ["har_status", "url"])]
+
+
+def create_indexes(analyze=True):
+    ''' Perfomance related optomizations
+
+    analyze - refresh the query planner statistics once the indexes exist
+    '''
+    for name, table, cols in INDEXES:
+        if table == REQUESTS:
+            table = request_table()
+        missing = set(cols) - set(table_columns(table))
+        if missing:
+            logging.debug("Skipping index {}, missing: {}".format(
+                name, ", ".join(sorted(missing))))
+            continue
+        execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+            name, table, ", ".join(cols)))
+    if analyze:
+        execute("ANALYZE")
+
+
+def table_exists(name, kind="table"):
+    q = "SELECT name FROM sqlite_master WHERE type == ? AND name == ?"
+    return execute(q, (kind, name)).fetchone() is not None
+
+
+def table_columns(name):
+    return [row[1] for row in execute("PRAGMA table_info({})".format(name))]
+
+
+def explain(q, args=None):
+    ''' Query plan of q as a list of strings, one per plan step
+
+    Parameters in q are bound to NULL unless args are given.
+    '''
+    if args is None:
+        args = (None,) * q.count("?")
+    rows = execute("EXPLAIN QUERY PLAN " + q, args).fetchall()
+    # the detail is always the last column (sqlite versions differ before it)
+    return [row[-1] for row in rows]
+
+
+##
+# Normalized request layout
+#
+# The request columns in DIMENSIONS repeat millions of times, in this layout
+# they are interned into dim_<col> tables (id, value) and requests_norm holds
+# the integer ids as <col>_id.  A requests view (with an INSTEAD OF INSERT
+# trigger) keeps the flat layout's columns so existing queries and inserts
+# work unchanged, while set math can run over the ids in requests_norm.
+# Once add_ad_column has run the view also has ad, updated through an
+# INSTEAD OF UPDATE trigger.
+##
+DIMENSIONS = ['etld', 'netloc', 'path', 'priv']
+NORM_REQUESTS = "requests_norm"
+# whether a request is an ad, added by ads.mark_ads
+AD = "ad"
+
+
+def normalized():
+    ''' True if the database uses the normalized request layout '''
+    return table_exists(NORM_REQUESTS)
+
+
+def request_table():
+    ''' The physical table holding request rows '''
+    return NORM_REQUESTS if normalized() else Request.name
+
+
+def id_column(col):
+    ''' Column of request_table() to use for set math over col '''
+    if col in DIMENSIONS and normalized():
+        return "{}_id".format(col)
+    return col
+
+
+def normalized_schema():
+    ''' Statements creating the normalized request layout '''
+    stmts = []
+    norm_cols = []
+    view_cols = []
+    joins = []
+    inserts = []
+    values = []
+    ad = table_exists(NORM_REQUESTS) and \
+        AD in table_columns(NORM_REQUESTS)
+    for c in Request.cols:
+        if c in DIMENSIONS:
+            dim = "dim_{}".format(c)
+            stmts.append("CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY "
+                         "KEY, value TEXT UNIQUE)".format(dim))
+            norm_cols.append("{}_id INTEGER".format(c))
+            view_cols.append("{}.value AS {}".format(dim, c))
+            joins.append("LEFT JOIN {dim} ON {dim}.id == r.{c}_id".format(
+                dim=dim, c=c))
+            inserts.append("INSERT OR IGNORE INTO {dim} (value) SELECT "
+                           "NEW.{c} WHERE NEW.{c} IS NOT NULL;".format(
+                               dim=dim, c=c))
+            values.append("(SELECT id FROM {} WHERE value == NEW.{})".format(
+                dim, c))
+        else:
+            norm_cols.append(c)
+            view_cols.append("r.{}".format(c))
+            values.append("NEW.{}".format(c))
+
+    stmts.append("CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY({}))".format(
+        NORM_REQUESTS, ",".join(norm_cols), Request.pk))
+    if ad:
+        view_cols.append("r.{}".format(AD))
+    stmts.append("CREATE VIEW IF NOT EXISTS {} AS SELECT {} FROM {} AS r "
+                 "{}".format(Request.name, ", ".join(view_cols),
+                             NORM_REQUESTS, " ".join(joins)))
+    stmts.append("CREATE TRIGGER IF NOT EXISTS requests_insert INSTEAD OF "
+                 "INSERT ON {} BEGIN {} INSERT OR IGNORE INTO {} ({}) "
+                 "VALUES ({}); END".format(
+                     Request.name, " ".join(inserts), NORM_REQUESTS,
+                     ", ".join(c.split()[0] for c in norm_cols),
+                     ", ".join(values)))
+    if ad:
+        stmts.append("CREATE TRIGGER IF NOT EXISTS requests_update_ad "
+                     "INSTEAD OF UPDATE OF {ad} ON {view} BEGIN UPDATE {norm} "
+                     "SET {ad} = NEW.{ad} WHERE {pk} == OLD.{pk}; END".format(
+                         ad=AD, view=Request.name, norm=NORM_REQUESTS,
+                         pk=Request.pk))
+    return stmts
+
+
+def add_ad_column():
+    ''' Add the ad column (see ads.mark_ads) to requests if it is missing '''
+    if AD in table_columns(Request.name):
+        return
+    if normalized():
+        execute("ALTER TABLE {} ADD COLUMN {} INTEGER".format(NORM_REQUESTS,
+                                                             AD))
+        # the view (and its triggers) are recreated with the column
+        execute("DROP VIEW IF EXISTS {}".format(Request.name))
+        for q in normalized_schema():
+            execute(q)
+    else:
+        execute("ALTER TABLE {} ADD COLUMN {} INTEGER".format(Request.name,
+                                                             AD))
+
+
+def _last_rowid(table):
+    return execute("SELECT max(rowid) FROM {}".format(table)).fetchone()[0] \
+        or 0
+
+
+class BulkIngest(object):
+    """Context manager for loading large amounts of data
+
+    While active, writes made through execute, store_many and execute_many are
+    batched into large transactions instead of being committed one statement
+    at a time.  The journal is switched to WAL, syncing is relaxed while
+    ingesting and index creation is deferred until the load finishes.
+
+        with storage.BulkIngest():
+            storage.store_many(items)
+
+    batch_size  - number of rows to write before committing
+    synchronous - sqlite synchronous setting to use while ingesting
+    """
+
+    def __init__(self, batch_size=100000, synchronous="OFF"):
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self.rows = 0
+        self.pending = 0
+        self.start = None
+
+    def __enter__(self):
+        global BULK
+        if not CONN:
+            connect_db()
+        # journal mode can not be changed inside of a transaction
+        CONN.commit()
+        CONN.execute("PRAGMA journal_mode=WAL")
+        CONN.execute("PRAGMA synchronous={}".format(self.synchronous))
+        self.start = timeit.default_timer()
+        BULK = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global BULK
+        BULK = None
+        CONN.commit()
+        if exc_type is None:
+            create_indexes()
+        CONN.execute("PRAGMA synchronous=NORMAL")
+        elapsed = timeit.default_timer() - self.start
+        logging.info("Bulk ingest: {} rows in {:.2f}s ({:.0f} rows/s)".format(
+            self.rows, elapsed, self.rate(elapsed)))
+        return False
+
+    def add(self, rows):
+        """Account for written rows and commit once a batch is full"""
+        self.rows += rows
+        self.pending += rows
+        if self.pending >= self.batch_size:
+            CONN.commit()
+            self.pending = 0
+
+    def rate(self, elapsed=None):
+        if elapsed is None:
+            elapsed = timeit.default_timer() - self.start
+        if elapsed <= 0:
+            return 0
+        return self.rows/elapsed
+
+
+def commit(rows=0):
+    ''' Commit, or defer to the active bulk ingest session '''
+    if BULK:
+        BULK.add(max(rows, 0))
+    else:
+        CONN.commit()
 
 
 def close():
@@ -136,39 +543,91 @@ def execute(q, args=None):
         cur.execute(q, args)
     else:
         cur.execute(q)
-    CONN.commit()
+    commit(cur.rowcount)
     return cur
 
 
-def get(query, args=None):
+def iterate(q, args=None, arraysize=ARRAYSIZE, row_type=None):
+    ''' Run a query and yield its rows, fetching arraysize rows at a time
+
+    row_type - None yields sqlite3.Row objects, tuple yields plain tuples and
+               a namedtuple class (eg: Table.row_type()) yields those
+    '''
+    if not CONN:
+        connect_db()
+    cur = CONN.cursor()
+    cur.arraysize = arraysize
+    if row_type is not None:
+        cur.row_factory = None
+    make = getattr(row_type, "_make", None)
+    cur.execute(q, args or ())
+    while True:
+        rows = cur.fetchmany()
+        if not rows:
+            break
+        for row in rows:
+            yield make(row) if make else row
+
+
+def stream(query, args=None, arraysize=ARRAYSIZE, row_type=None):
+    ''' Generator version of get, see iterate '''
     if query in GET_Q:
-        return execute(GET_Q[query], args).fetchall()
+        return iterate(GET_Q[query], args, arraysize, row_type)
     else:
-        return []
+        return iter([])
 
 
-def store_many(items):
+def get(query, args=None):
+    return list(stream(query, args))
+
+
+def store_many(items, replace=False):
     """ Data is a list of items"""
 
     if len(items) > 0:
         sample = items[0]
-        q = "?,"*len(sample.data)
-        insert = "INSERT OR IGNORE INTO {} VALUES ({})".format(sample.name,
-                                                               q[:-1])
         data = [item.data.values() for item in items]
+        return store_rows(sample, data, replace)
+    else:
+        return 0
+
+
+def store_rows(table, rows, replace=False):
+    """ Insert rows of raw values, ordered as in table.cols, into table
+
+    replace - overwrite existing rows instead of ignoring the new ones
+    """
+    if len(rows) > 0:
+        q = "?,"*len(table.cols)
+        # columns are named, tables can gain some (eg: requests.ad)
+        insert = "INSERT OR {} INTO {} ({}) VALUES ({})".format(
+                "REPLACE" if replace else "IGNORE", table.name,
+                ", ".join(c.split()[0] for c in table.cols), q[:-1])
+        # inserts through the requests view (normalized layout) report no
+        # rowcount, its rows are counted from the rowids of requests_norm
+        view = table.name == Request.name and normalized()
+        if view:
+            last = _last_rowid(NORM_REQUESTS)
         cur = CONN.cursor()
-        cur.executemany(insert, data)
-        CONN.commit()
-        return cur.rowcount
+        cur.executemany(insert, rows)
+        count = cur.rowcount
+        if view:
+            count = _last_rowid(NORM_REQUESTS) - last
+        commit(count)
+        return count
     else:
         return 0
 
 
 def execute_many(query, items):
+    # rowcount misses the rows written by triggers (eg: updates through the
+    # requests view), those are counted by total_changes
+    changes = CONN.total_changes
     cur = CONN.cursor()
     cur.executemany(query, items)
-    CONN.commit()
-    return cur.rowcount
+    count = max(cur.rowcount, CONN.total_changes - changes)
+    commit(count)
+    return count
 
 
 # Data Queries used in comparing loads
@@ -179,13 +638,20 @@ GET_URLS = "SELECT url FROM pages GROUP BY url"
 GET_REQ = "SELECT * from requests"
 GET_PARSED_HAR = "SELECT page_id FROM requests GROUP BY page_id"
 GET_PAGES_FOR_URL = "SELECT * FROM pages WHERE url == ?"
+GET_SUCCESS_URLS = "SELECT url, count(url) FROM pages "\
+                   "WHERE har_status == 'success' GROUP BY url"
+GET_SUCCESS_PAGES_FOR_URL = "SELECT page_id, start_time FROM pages "\
+                            "WHERE har_status == 'success' AND url == ? "\
+                            "ORDER BY start_time ASC"
 
 GET_Q = {"run": GET_RUNS,
          "page": GET_PAGES,
          "urls": GET_URLS,
          "req": GET_REQ,
          "parsed_har": GET_PARSED_HAR,
-         "pages_for_url": GET_PAGES_FOR_URL}
+         "pages_for_url": GET_PAGES_FOR_URL,
+         "success_urls": GET_SUCCESS_URLS,
+         "success_pages_for_url": GET_SUCCESS_PAGES_FOR_URL}
 
 ITEMS = {"run": Run,
          "page": Page,
@@ -5,6 +5,7 @@ Common helper functions that are used across multiple modules.
 """
 
 import csv
+import hashlib
 import json
 import logging
 import os
@@ -38,6 +39,15 @@ def load_json(fname):
     return data
 
 
+def file_digest(fname, chunk_size=1024*1024):
+    """Return the sha1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def save_yaml(data, fname):
     """Write data to a yaml file (used for job configurations)
     """
@@ -86,25 +86,18 @@ def site_over_time(site_data, x_max, file_name, title):
     clear()
 
 
-def binned_fp_stacked_area(indexed_data,
+def binned_fp_stacked_area(y_data,
                            file_name,
                            title,
                            bins=[0, 0.0000001, 5, 10, 15, 100]):
+    """
+    y_data: the fraction of sites in each of the bins at each load index,
+            see gen_fingerprint.binned_false_positive_rate
+    """
 
     matplotlib.rcParams.update({'font.size': 22})
     bin_labels = [bins[0]] + bins[2:]
     bin_colors = ['g', 'b', 'm', 'y', 'r']
-    y_data = []
-    y_max = 0
-    for x in indexed_data:
-        index, data = x
-        index_tot = float(len(data))
-        y_max = max(y_max, index_tot)
-        # Need to handle situations where we no longer have enough data,
-        # due to failed loads. ~2% of data
-        if index_tot/float(y_max) >= 0.9:
-            normed_bins = [x/index_tot for x in np.histogram(data, bins)[0]]
-            y_data.append(normed_bins)
 
     x_data = range(len(y_data))
     print "start: {}".format(y_data[0:7])
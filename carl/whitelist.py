@@ -0,0 +1,165 @@
+"""Whitelist Decision Service
+
+Answers "is a request to domain X allowed on site Y" from a stored fingerprint
+(see gen_fingerprint.load_fingerprint) over HTTP, rather than having every
+client parse the filter list of gen_fingerprint.save_fingerprint_for_plugin.
+
+Decisions follow the $domain= rules of that list: a whitelisted domain also
+allows its subdomains, a site's whitelist also applies on its subdomains and
+sites without a fingerprint allow every request.  Both are looked up by
+walking the suffixes of the host (eg: a.b.com, b.com, com) in hash tables.
+
+    GET  /check?site=Y&domain=X        {"allowed": true}
+    POST /check {"queries": [[Y, X], ...]}   {"allowed": [true, ...]}
+"""
+
+import BaseHTTPServer
+import json
+import logging
+import SocketServer
+import timeit
+import urlparse
+
+from carl import gen_fingerprint as gf
+
+DEFAULT_PORT = 8000
+
+
+def host(value):
+    """ The lower cased host of a url, or of a host (with or without port) """
+    if "://" in value:
+        value = urlparse.urlparse(value).netloc
+    return value.split(":", 1)[0].strip(".").lower()
+
+
+def suffixes(hostname):
+    """ The host and each of its parent domains, most specific first """
+    yield hostname
+    i = hostname.find(".")
+    while i != -1:
+        yield hostname[i + 1:]
+        i = hostname.find(".", i + 1)
+
+
+class WhitelistIndex(object):
+    """ dict[site host]frozenset of whitelisted domains """
+
+    def __init__(self, fingerprints):
+        self.sites = {}
+        # whitelists share their domain strings
+        interned = {}
+        for site_url, fp in fingerprints.iteritems():
+            if isinstance(fp, dict):
+                # rolling, the most recent whitelist
+                if not fp:
+                    continue
+                whitelist = fp[max(fp)]["fp"]
+            else:
+                whitelist, used_pages, valid_after = fp
+            self.sites[host(site_url)] = frozenset(
+                    interned.setdefault(dom, dom) for dom in whitelist
+                    if dom is not None)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def whitelist(self, site):
+        """ The whitelist that applies on site, None if there is none """
+        for suffix in suffixes(host(site)):
+            whitelist = self.sites.get(suffix)
+            if whitelist is not None:
+                return whitelist
+        return None
+
+    def allowed(self, site, domain):
+        whitelist = self.whitelist(site)
+        if whitelist is None:
+            return True
+        return any(s in whitelist for s in suffixes(host(domain)))
+
+    def check(self, queries):
+        """ allowed for each (site, domain) """
+        # batches tend to hold many requests of a few sites
+        whitelists = {}
+        out = []
+        for site, domain in queries:
+            if site not in whitelists:
+                whitelists[site] = self.whitelist(site)
+            whitelist = whitelists[site]
+            out.append(whitelist is None or
+                       any(s in whitelist for s in suffixes(host(domain))))
+        return out
+
+
+def load_index(name, fp_id=None):
+    start = timeit.default_timer()
+    fingerprints, _ = gf.load_fingerprint(name, fp_id=fp_id)
+    index = WhitelistIndex(fingerprints)
+    logging.info("Loaded {} site whitelists of {} in {:.2f}s".format(
+        len(index), name, timeit.default_timer() - start))
+    return index
+
+
+class WhitelistHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep connections open between batches
+    protocol_version = "HTTP/1.1"
+    # write each response at once, without waiting on the client's acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/check":
+            return self.reply(404, {"error": "unknown path"})
+        args = urlparse.parse_qs(url.query)
+        if "site" not in args or "domain" not in args:
+            return self.reply(400, {"error": "site and domain are required"})
+        allowed = self.server.index.allowed(args["site"][0],
+                                            args["domain"][0])
+        self.reply(200, {"allowed": allowed})
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != "/check":
+            return self.reply(404, {"error": "unknown path"})
+        length = int(self.headers.getheader("content-length", 0))
+        try:
+            queries = json.loads(self.rfile.read(length))["queries"]
+            allowed = self.server.index.check(queries)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.reply(400, {"error": "expected "
+                                    "{\"queries\": [[site, domain], ...]}"})
+        self.reply(200, {"allowed": allowed})
+
+    def reply(self, status, body):
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # not address_string(), which looks up the client's name
+        logging.debug("%s - %s", self.client_address[0], format % args)
+
+
+class WhitelistServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serve an index, a thread per connection """
+    daemon_threads = True
+
+    def __init__(self, index, address):
+        BaseHTTPServer.HTTPServer.__init__(self, address, WhitelistHandler)
+        self.index = index
+
+
+def serve(name, bind="", port=DEFAULT_PORT, fp_id=None):
+    """ Serve the whitelists of the stored fingerprint name until ^C """
+    server = WhitelistServer(load_index(name, fp_id), (bind, port))
+    logging.info("Serving {} at http://{}:{}/check".format(
+        name, bind or "0.0.0.0", server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,51 @@
+"""
+Compare the haralyzer and streaming HAR readers used by make_db
+
+Each reader parses every HAR in the directory (default: cwd) in a fresh
+process so that the peak memory (max rss) of the two can be compared.
+
+    python ../scripts/bench_har_reader.py [data_dir]
+"""
+import glob
+import multiprocessing
+import os
+import resource
+import sys
+import timeit
+
+from tabulate import tabulate
+
+from carl import analysis
+
+
+def run(stream, hars, out):
+    analysis.init_psl()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = timeit.default_timer()
+    num_req = 0
+    for h in hars:
+        num_req += len(analysis._parse_har(h, stream=stream))
+    elapsed = timeit.default_timer() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    out.put((elapsed, num_req, base_rss, peak_rss))
+
+
+data_dir = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+hars = glob.glob(data_dir + "/*.har")
+har_mb = sum([os.path.getsize(h) for h in hars]) / float(1024 * 1024)
+print "Benchmarking {} HAR files ({:.1f} MB)".format(len(hars), har_mb)
+
+table = []
+for name, stream in [("haralyzer", False), ("stream", True)]:
+    out = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run, args=(stream, hars, out))
+    p.start()
+    elapsed, num_req, base_rss, peak_rss = out.get()
+    p.join()
+    table.append([name, len(hars), num_req, elapsed,
+                  len(hars) / elapsed, har_mb / elapsed,
+                  (peak_rss - base_rss) / 1024.0])
+
+headers = ["reader", "har", "requests", "time (s)", "har/s", "MB/s",
+           "peak rss growth (MB)"]
+print tabulate(table, headers=headers, floatfmt=".2f")
@@ -0,0 +1,99 @@
+"""
+Load test the whitelist decision service (carl serve-whitelist)
+
+Serves a stored fingerprint from a separate process and sends it batches of
+(site, request domain) queries taken from the requests in the database, from
+a number of client threads over persistent connections.  The answers are
+checked against the index in this process.
+
+    python ../scripts/bench_serve_whitelist.py name [batch] [clients] [queries]
+"""
+import httplib
+import json
+import multiprocessing
+import sys
+import threading
+import timeit
+
+import numpy as np
+from tabulate import tabulate
+
+from carl import storage
+from carl import whitelist
+
+SAMPLE_Q = "SELECT p.url, r.netloc FROM pages AS p "\
+           "JOIN requests AS r ON r.page_id == p.page_id "\
+           "WHERE p.har_status == 'success' LIMIT ?"
+
+
+def run_server(name, out):
+    server = whitelist.WhitelistServer(whitelist.load_index(name),
+                                       ("127.0.0.1", 0))
+    out.put(server.server_port)
+    server.serve_forever()
+
+
+def run_client(port, batches, latencies, answers):
+    conn = httplib.HTTPConnection("127.0.0.1", port)
+    headers = {"Content-Type": "application/json"}
+    for i, batch in batches:
+        body = json.dumps({"queries": batch})
+        start = timeit.default_timer()
+        conn.request("POST", "/check", body, headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        latencies.append(timeit.default_timer() - start)
+        answers[i] = json.loads(data)["allowed"]
+    conn.close()
+
+
+def load_test(port, queries, batch, clients):
+    batches = [queries[i:i + batch] for i in range(0, len(queries), batch)]
+    answers = [None] * len(batches)
+    latencies = []
+    threads = [threading.Thread(
+        target=run_client,
+        args=(port, list(enumerate(batches))[c::clients], latencies, answers))
+        for c in range(clients)]
+    start = timeit.default_timer()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = timeit.default_timer() - start
+    return [a for answer in answers for a in answer], latencies, elapsed
+
+
+name = sys.argv[1]
+batch = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+clients = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+num_queries = int(sys.argv[4]) if len(sys.argv) > 4 else 100000
+
+# started before this process opens the database
+ports = multiprocessing.Queue()
+server = multiprocessing.Process(target=run_server, args=(name, ports))
+server.daemon = True
+server.start()
+port = ports.get()
+
+queries = [list(row) for row in storage.iterate(SAMPLE_Q, (num_queries,),
+                                                row_type=tuple)]
+expected = whitelist.load_index(name).check(queries)
+print "Load testing {} with {} queries ({:.1%} allowed)".format(
+    name, len(queries), sum(expected) / float(max(len(queries), 1)))
+
+table = []
+for size in sorted(set([1, batch])):
+    # single queries are slow, a sample of them is enough
+    sample = queries if size > 1 else queries[:max(1, len(queries) / 10)]
+    allowed, latencies, elapsed = load_test(port, sample, size, clients)
+    latencies = np.array(latencies) * 1000
+    mismatched = sum(a != e for a, e in zip(allowed, expected))
+    table.append([size, clients, len(sample), len(sample) / elapsed,
+                  np.percentile(latencies, 50), np.percentile(latencies, 99),
+                  np.percentile(latencies, 50) * 1000 / size, mismatched])
+server.terminate()
+
+headers = ["batch", "clients", "queries", "queries/s", "p50 (ms)",
+           "p99 (ms)", "p50/query (us)", "mismatched"]
+print tabulate(table, headers=headers, floatfmt=".3f")
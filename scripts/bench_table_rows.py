@@ -0,0 +1,74 @@
+"""
+Object footprint and creation rate of storage.Request rows
+
+Compares the slot based Table records against the previous layout, where
+every instance carried its own OrderedDict of the columns.  Each variant
+creates and holds N requests (default: 1M) in a fresh process.
+
+    python scripts/bench_table_rows.py [n]
+"""
+import collections
+import multiprocessing
+import resource
+import sys
+import timeit
+
+from tabulate import tabulate
+
+from carl import storage
+
+
+class OrderedDictRequest(object):
+    """The Table layout before slot based records"""
+    cols = storage.Request.cols
+
+    def __init__(self, values=None):
+        self.data = collections.OrderedDict([(c, None) for c in self.cols])
+        if values:
+            for k, v in values.iteritems():
+                if k in self.data:
+                    self.data[k] = v
+
+
+def sample(i):
+    return {'req_id': "req-{}".format(i),
+            'page_id': "page-{}".format(i / 50),
+            'status': 200,
+            'scheme': "http",
+            'url': "http://cdn.example.com/static/{}.js".format(i),
+            'etld': "example.com",
+            'priv': "example.com",
+            'netloc': "cdn.example.com",
+            'path': "/static/{}.js".format(i),
+            'query': "[]",
+            'content_hash': None}
+
+
+def run(cls, n, out):
+    values = [sample(i) for i in xrange(n)]
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = timeit.default_timer()
+    items = [cls(v) for v in values]
+    elapsed = timeit.default_timer() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    out.put((elapsed, (peak_rss - base_rss) * 1024.0 / len(items)))
+
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+table = []
+for name, cls in [("OrderedDict", OrderedDictRequest),
+                  ("slots", storage.Request)]:
+    out = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run, args=(cls, n, out))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        # eg: killed for running out of memory
+        table.append([name, n, None, None, None])
+        continue
+    elapsed, per_obj = out.get()
+    table.append([name, n, elapsed, n / elapsed, per_obj])
+
+headers = ["record", "requests", "create (s)", "requests/s",
+           "bytes/request (rss)"]
+print tabulate(table, headers=headers, floatfmt=".2f")
@@ -9,7 +9,7 @@ j_fails = [[r[1] for p, r in e.iteritems()] for e in just_eval]
 
 flat_fails = [i for fail in j_fails for i in fail]
 
-non_empt = [x for x in flat_fails if x != []]
+non_empt = [x for x in flat_fails if gf.failed_count(x) > 0]
 
 interactions = len(non_empt)
 # print non_empt
@@ -1,4 +1,5 @@
-from copy import deepcopy
+from functools import partial
+
 from carl import gen_fingerprint as gf
 from carl import viz_fingerprint as viz
 
@@ -6,21 +7,23 @@ LIMIT = 776
 # compute across 3 different starting n's
 for first_n in [1, 10, 20]:
     print "Generating baseline fingerprint for n={}".format(first_n)
-    fp = gf.gen_fingerprint(limit=LIMIT, n=first_n)
-
-    # g_ex = {"top_90per": {"q": 90, "n": 0},
-    #        "top_95per": {"q": 95, "n": 0},
-    #        "top_99per": {"q": 99, "n": 0},
-    g_ex = {"top_10": {"q": 0, "n": 10},
-            "top_20": {"q": 0, "n": 20},
-            "top_50": {"q": 0, "n": 50},
-            "top_100": {"q": 0, "n": 100}}
-
-    print "Copying and extending with globals"
-    # get fresh copies of the baseline fingerprint and add various globals
+    fp = gf.gen_fingerprint(limit=LIMIT,
+                            fp_func=partial(gf.first_n_loads, n=first_n))
+
+    # g_ex = {"top_90per": {"q": 90, "k": 0},
+    #        "top_95per": {"q": 95, "k": 0},
+    #        "top_99per": {"q": 99, "k": 0},
+    g_ex = {"top_10": {"q": 0, "k": 10},
+            "top_20": {"q": 0, "k": 20},
+            "top_50": {"q": 0, "k": 50},
+            "top_100": {"q": 0, "k": 100}}
+
+    print "Extending with globals"
+    # the globals are overlaid on the baseline fingerprint, which is unchanged
+    freq = gf.domain_frequency(fp)
     for test, param in g_ex.iteritems():
-        g_ex[test]["fp"] = gf.add_top_global(
-                deepcopy(fp), q=param["q"], n=param["n"])
+        g_ex[test]["fp"] = gf.add_global_top(
+                fp, q=param["q"], k=param["k"], freq=freq)
 
     # add back in the baseline case
     g_ex["baseline"] = {"fp": fp}
@@ -38,8 +41,8 @@ for first_n in [1, 10, 20]:
 
         print "Generating charts"
         # stacked chart
-        indexed_data = gf.avg_false_positive_rate(fp_res)
-        viz.binned_fp_stacked_area(indexed_data, "stack."+name, title)
+        binned = gf.binned_false_positive_rate(fp_res)
+        viz.binned_fp_stacked_area(binned, "stack."+name, title)
 
         # box and whisker charts
         agg_data = gf.summerize_and_aggregate(
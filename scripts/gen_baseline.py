@@ -1,3 +1,5 @@
+import multiprocessing
+
 from carl import gen_fingerprint as gf
 
-gf.gen_matrix(prefix="real")
+gf.gen_matrix(prefix="real", workers=multiprocessing.cpu_count())
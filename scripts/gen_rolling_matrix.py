@@ -1,17 +1,19 @@
 
+import multiprocessing
+
 from carl import gen_fingerprint as gf
 
 base_n = [1, 5, 10]
 base_f = [14, 7, 4, 1]
 prefix = "real_rolling"
 limit = 0
+workers = multiprocessing.cpu_count()
+sweep_res = gf.sweep(rolling=[(n, f) for n in base_n for f in base_f],
+                     limit=limit, workers=workers)
 for n in base_n:
     for f in base_f:
         name = "{}.n{}.f{}.{}".format(prefix, n, f, limit)
-        print "working on {}".format(name)
-        fp = gf.gen_fingerprint(n=n, f=f, limit=limit)
-        print "testing"
-        res = gf.test_rolling_fingerprint(fp)
+        fp, res = sweep_res[("rolling", n, f)]
         print "Store: {}".format(name)
         gf.store_fingerprints(fp, name, res)
         f_name = "test.stacked.{}.png".format(name)
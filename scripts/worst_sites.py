@@ -3,7 +3,8 @@ from operator import itemgetter
 import carl.gen_fingerprint as gf
 
 fp, res = gf.load_fingerprint("real.first_n.20.0")
-res_fail = {site: data for site, data in res.iteritems() if not data["all_valid"]}
+# only the failing sites are read from the stored results
+res_fail = {site: res[site] for site in gf.get_failed(res)}
 
 site_fps, _ = gf.time_order_false_positive_percent(res_fail)
 avg_fp = {site: sum(data.values())/float(len(data)) for site, data in site_fps.iteritems()}